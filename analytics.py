@@ -0,0 +1,103 @@
+from collections import namedtuple
+import numpy
+
+ABSOLUTE_ZERO = 273.15
+SECONDS_PER_DAY = 24 * 60 * 60
+# Condition code hundreds that mean something is falling, http://openweathermap.org/weather-conditions
+WET_CONDITIONS = (2, 3, 5, 6)  # Thunderstorm, drizzle, rain and snow
+Day = namedtuple('Day', 'day start end temp_min temp_max temp_mean condition precipitation wind_mean wind_max '
+                        'wind_direction pressure humidity clouds')
+
+
+# Conversions, each works on a single number or on a whole column at once
+def kelvin_to_celsius(kelvin):
+    return numpy.subtract(kelvin, ABSOLUTE_ZERO)
+
+
+def kelvin_to_fahrenheit(kelvin):
+    return numpy.subtract(kelvin, ABSOLUTE_ZERO) * 1.8 + 32
+
+
+def hpa_to_pa(hpa):
+    return numpy.multiply(hpa, 100)
+
+
+def ms_to_kmh(speed):
+    return numpy.multiply(speed, 3.6)
+
+
+def ms_to_mph(speed):
+    return numpy.multiply(speed, 2.2369362920544)
+
+
+class ForecastTable:
+    """A location's forecasts as NumPy columns, with the converted and per day figures the screens show.
+
+    Built from a ForecastStore, whose arrays are copied in one go rather than read a Forecast at a time. Every
+    column is worked out for all rows in one vectorised pass. Days and hours are the store's, local to the location.
+    """
+    def __init__(self, store):
+        self.location_id = store.location_id
+        for column, typecode in zip(store.columns, store.typecodes):
+            setattr(self, column, numpy.array(getattr(store, column), dtype=typecode))
+        self.day = numpy.array(store.day, dtype=store.day.typecode)  # Days since 1970 at the location
+        self.hour = numpy.array(store.hour, dtype=store.hour.typecode)
+        self.celsius = kelvin_to_celsius(self.temp)
+        self.pascals = hpa_to_pa(self.pressure)
+        self.wet = numpy.isin(self.symbol_number // 100, WET_CONDITIONS)
+        self.summaries = None  # What days returns, worked out the first time it's asked for
+
+    def __len__(self):
+        return len(self.time)
+
+    def index(self, time):
+        # Row of the forecast at time, the columns are sorted by time like the store's
+        return int(numpy.searchsorted(self.time, time))
+
+    def days(self):
+        """A Day per local day with forecasts, in order. Temperatures are in Celsius and precipitation is the share
+        of the day's forecasts with a wet condition."""
+        if self.summaries is None:
+            self.summaries = self.summarise() if len(self) else []
+        return self.summaries
+
+    def day_of(self, index):
+        for day in self.days():
+            if day.start <= index < day.end:
+                return day
+        return None
+
+    def summarise(self):
+        starts = numpy.flatnonzero(numpy.diff(self.day)) + 1
+        starts = numpy.concatenate(([0], starts))
+        ends = numpy.concatenate((starts[1:], [len(self)]))
+        counts = ends - starts
+        temp_min = numpy.minimum.reduceat(self.celsius, starts)
+        temp_max = numpy.maximum.reduceat(self.celsius, starts)
+        temp_mean = numpy.add.reduceat(self.celsius, starts) / counts
+        precipitation = numpy.add.reduceat(self.wet.astype(numpy.int64), starts) / counts
+        wind_mean = numpy.add.reduceat(self.wind_speed, starts) / counts
+        wind_max = numpy.maximum.reduceat(self.wind_speed, starts)
+        # Wind direction averaged as vectors weighted by speed, so 350 and 10 degrees average to 0 not 180
+        radians = numpy.radians(self.wind_direction)
+        east = numpy.add.reduceat(self.wind_speed * numpy.sin(radians), starts)
+        north = numpy.add.reduceat(self.wind_speed * numpy.cos(radians), starts)
+        wind_direction = numpy.degrees(numpy.arctan2(east, north)) % 360
+        pressure = numpy.add.reduceat(self.pressure, starts) / counts  # hPa, like the forecasts
+        humidity = numpy.add.reduceat(self.humidity, starts) / counts
+        clouds = numpy.add.reduceat(self.clouds, starts) / counts
+        return [Day(*values) for values in zip(self.day[starts].tolist(), starts.tolist(), ends.tolist(),
+                                               temp_min.tolist(), temp_max.tolist(), temp_mean.tolist(),
+                                               self.dominant_conditions(starts).tolist(), precipitation.tolist(),
+                                               wind_mean.tolist(), wind_max.tolist(), wind_direction.tolist(),
+                                               pressure.tolist(), humidity.tolist(), clouds.tolist())]
+
+    def dominant_conditions(self, starts):
+        # The most common condition code of each day, the earliest one seen on a tie
+        group = numpy.zeros(len(self), dtype=numpy.int64)
+        group[starts[1:]] = 1
+        group = numpy.cumsum(group)
+        pairs, first, counts = numpy.unique(group * 1000 + self.symbol_number, return_index=True, return_counts=True)
+        order = numpy.lexsort((first, -counts, pairs // 1000))  # By day, then most common, then earliest
+        days, best = numpy.unique(pairs[order] // 1000, return_index=True)
+        return pairs[order][best] % 1000
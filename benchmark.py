@@ -0,0 +1,798 @@
+"""Micro-benchmarks for the weather database.
+
+Run with ``python benchmark.py``, or ``python benchmark.py query_paths
+refresh --json results.json`` for some of them with the results also
+written out as JSON. Every benchmark swaps the module level database for
+a fresh in-memory one before it starts. Nothing needs a window or the
+network, responses come from synthetic OpenWeatherMap fixtures.
+"""
+import argparse
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from itertools import cycle
+import json
+import os
+import platform
+import shutil
+from socketserver import ThreadingMixIn
+import sqlite3
+from string import Formatter
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from threading import Lock, Thread
+from time import sleep, time
+from urllib.parse import parse_qs, urlparse
+
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+os.environ.setdefault('KIVY_NO_CONSOLELOG', '1')
+import analytics
+import database
+import gazetteer
+import history
+import instrumentation
+import response_cache
+
+
+def use_memory_database():
+    return use_database(':memory:')
+
+
+def use_database(file, read_connections=database.READ_CONNECTIONS):
+    database._db.use(lambda: database.MultiThreadedWeatherDatabase(file, read_connections))
+    database.Location.clear_cache()
+    response_cache._cache.use(lambda: response_cache.ResponseCache(':memory:'))  # Every run goes to the network
+    return database._db
+
+
+class FakeOpenWeatherMap(ThreadingMixIn, HTTPServer):
+    """Serves forecast_json on /forecast and find_json on /find after a fixed delay, recording how many requests
+    overlapped.
+
+    Location ids in failing get a 500 instead.
+    """
+    daemon_threads = True
+
+    def __init__(self, delay=0.05, slots=40):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeOpenWeatherMapHandler)
+        self.delay = delay
+        self.slots = slots
+        self.lock = Lock()
+        self.active = 0
+        self.most_active = 0
+        self.requests = 0
+        self.failing = set()
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return Formatter().format('http://127.0.0.1:{port}', port=self.server_address[1])
+
+
+class FakeOpenWeatherMapHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.requests += 1
+            server.most_active = max(server.most_active, server.active)
+        sleep(server.delay)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/find':
+            self.send_json(find_json(query['q'][0], 5))
+        elif int(query['id'][0]) in server.failing:
+            self.send_response(500)
+            self.end_headers()
+        elif self.headers.get('If-None-Match') == '"' + query['id'][0] + '"':
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_json(forecast_json(int(query['id'][0]), server.slots, int(time())), '"' + query['id'][0] + '"')
+        with server.lock:
+            server.active -= 1
+
+    def send_json(self, data, etag=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def seed_locations(count):
+    for location_id in range(count):
+        database._db.execute('''INSERT INTO location VALUES (?,?,?,?,?,?,?)''',
+                             (location_id, 'Town' + str(location_id), 'GB', 51.5, -0.1, location_id, 0))
+
+
+def forecast_json(location_id, count, start=0, warmer=0.0):
+    """Builds a response shaped like OpenWeatherMap's forecast endpoint with one slot every 3 hours."""
+    return {
+        'cod': '200',
+        'city': {'id': location_id},
+        'list': [{
+            'dt': start + slot * 10800,
+            'main': {'temp': 270.0 + slot % 20 + warmer, 'pressure': 1000 + slot % 30, 'humidity': slot % 100},
+            'clouds': {'all': slot % 100},
+            'wind': {'speed': slot % 15 * 0.5, 'deg': slot * 7 % 360},
+            'weather': [{'id': (500, 800, 801, 300, 600)[slot % 5]}]
+        } for slot in range(count)]
+    }
+
+
+def find_json(query, count):
+    """Builds a response shaped like OpenWeatherMap's find endpoint, towns whose names start with query."""
+    return {
+        'cod': '200',
+        'count': count,
+        'list': [{
+            'id': 100000 + town,
+            'name': query.title() + ' ' + str(town),
+            'sys': {'country': 'GB'},
+            'coord': {'lat': 50.0 + town * 0.1, 'lon': -1.0 + town * 0.1}
+        } for town in range(count)]
+    }
+
+
+def seed_forecasts(location_id, count, start):
+    """Inserts rows straight into the forecast table, past ones included, without going through the store."""
+    with database._db.transaction() as transaction:
+        transaction.executemany('''INSERT INTO forecast (location_id, time, temp, pressure, humidity, clouds, '''
+                                '''windspeed, winddirection, symbol) VALUES (?,?,?,?,?,?,?,?,?)''',
+                                [(location_id, start + slot * 10800, 270.0 + slot % 20, 1000 + slot % 30, slot % 100,
+                                  slot % 100, slot % 15 * 0.5, slot * 7 % 360, 800) for slot in range(count)])
+    transaction.future.result()  # Raises if the rows weren't written, so no benchmark runs on an empty table
+
+
+def wait_for_writes():
+    database._db.flush().result()  # Returns once every queued job has been committed
+
+
+RESULTS = []  # Every result emitted, for --json
+running = [None]  # Name of the benchmark being run
+
+
+def emit(template, **values):
+    """Prints a result and keeps it, values and all, for the JSON output."""
+    line = Formatter().format(template, **values)
+    print(line)
+    RESULTS.append(dict(values, benchmark=running[0], line=line))
+
+
+def timed(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time()
+        function()
+        timings.append(time() - start)
+    timings.sort()
+    return timings
+
+
+def report(name, timings):
+    emit('{name:<32} mean {mean:8.3f} ms   p50 {p50:8.3f} ms   max {max:8.3f} ms',
+         name=name,
+         mean=sum(timings) / len(timings) * 1000,
+         p50=timings[len(timings) // 2] * 1000,
+         max=timings[-1] * 1000)
+
+
+STARTUP = '''
+from time import time
+start = time()
+import json, os, sys, threading
+os.environ['KIVY_NO_ARGS'] = '1'
+os.environ['KIVY_NO_CONSOLELOG'] = '1'
+import database
+database.DATABASE_FILE = sys.argv[1]
+imported = time()
+threads = threading.active_count()
+import main
+from kivy.base import EventLoop
+from kivy.clock import Clock
+from kivy.lang import Builder
+Builder.load_file('weather.kv')
+app = main.WeatherApp()
+app.root = app.build()
+app.built = True
+times = {'import': imported - start, 'threads': threads, 'build': time() - start}
+
+
+def timed(stage, function):
+    # function, noting when it's first called
+    def call(*args):
+        times.setdefault(stage, time() - start)
+        return function(*args)
+    return call
+app.on_first_frame = timed('first frame', app.on_first_frame)
+app.maintenance = timed('maintenance', app.maintenance)
+app._run_prepare()  # What App.run does before its loop, it dispatches on_start once the window is up
+times['start'] = time() - start
+Clock.schedule_once(lambda dt: times.setdefault('first tick', time() - start))
+menu = main.root.get_screen('menu')
+EventLoop.start()
+while 'maintenance' not in times:
+    EventLoop.idle()
+    if 'menu' not in times and len(menu.location_grid.children) >= 2:  # The + button and at least one location
+        times['menu'] = time() - start
+app.scheduler.pause()  # Only what happens until maintenance is measured, not the refreshes it starts
+app.compactor.pause()
+EventLoop.close()
+json.dump(times, sys.stdout)
+database._db.close(wait=True)
+'''
+
+
+def bench_startup(locations=10, slots=40, runs=5):
+    """Fresh processes from start until WeatherApp's deferred maintenance runs, by way of on_start, the first Clock
+    tick and frame after it and the menu showing saved locations."""
+    directory = tempfile.mkdtemp()
+    try:
+        file = os.path.join(directory, 'weather.db')
+        use_database(file)
+        seed_locations(locations)
+        for location_id in range(locations):
+            seed_forecasts(location_id, slots, int(time()))
+        database._db.close(wait=True)
+        environment = dict(os.environ, KIVY_NO_ARGS='1', KIVY_NO_CONSOLELOG='1')
+        runs = [json.loads(subprocess.check_output([sys.executable, '-c', STARTUP, file], env=environment,
+                                                   cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8'))
+                for _ in range(runs)]
+        for stage in ('import', 'build', 'start', 'first tick', 'first frame', 'menu', 'maintenance'):
+            report('startup to ' + stage, sorted(run[stage] for run in runs))
+        emit('{name:<32} {threads} threads after importing database', name='startup', threads=runs[0]['threads'])
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_select_latency(repeat=50):
+    use_memory_database()
+    seed_locations(20)
+    report('Location.from_id', timed(lambda: database.Location.from_id(7), repeat))
+    report('Location.from_id (uncached)', timed(lambda: (database.Location.clear_cache(),
+                                                         database.Location.from_id(7)), repeat))
+    report('Location.all_locations', timed(database.Location.all_locations, repeat))
+
+
+def bench_select_round_trip(repeat=200):
+    """A trivial select, so only the hand over to a database thread and back is measured."""
+    directory = tempfile.mkdtemp()
+    try:
+        use_database(os.path.join(directory, 'weather.db'))  # On disk, an in-memory database has no read pool
+        report('select round trip (read pool)', timed(lambda: list(database._db.select('''SELECT 1''')), repeat))
+        report('select round trip (writer)', timed(lambda: list(database._db.select('''SELECT 1''',
+                                                                                    after_writes=True)), repeat))
+        database._db.close(wait=True)
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_write_throughput(rows=2000):
+    directory = tempfile.mkdtemp()
+    try:
+        use_database(os.path.join(directory, 'weather.db'))  # On disk so every commit pays for its fsync
+        seed_locations(1)
+        command = '''INSERT INTO forecast(location_id, time, temp, pressure, humidity, clouds, windspeed, ''' \
+                  '''winddirection, symbol) VALUES (?,?,?,?,?,?,?,?,?)'''
+        start = time()
+        for row in range(rows):
+            database._db.execute(command, (0, row, 280.0, 1012, 80, 40, 3.5, 180, 500))
+        wait_for_writes()
+        elapsed = time() - start
+        emit('{name:<32} {rows} rows in {elapsed:.3f} s   {rate:10.0f} rows/s',
+             name='queued forecast inserts', rows=rows, elapsed=elapsed, rate=rows / elapsed)
+        database._db.close(wait=True)
+    finally:
+        shutil.rmtree(directory)
+
+
+def check_store_sync():
+    """ForecastStore.sync's counts and columns against what a refresh should do, raises AssertionError if not."""
+    rows = [(0, slot * 10800, 280.0 + slot, 1000, 50, 20, 2.0, 90, 800) for slot in range(10)]
+    store = database.ForecastStore(0, rows[:6])
+    changed = [rows[2][:2] + (300.0,) + rows[2][3:]]  # A new temperature for a slot already held
+    changed, skipped, pruned = store.sync(rows[2:4] + changed + rows[6:], 2 * 10800)
+    assert (len(changed), skipped, pruned) == (5, 2, 2), (len(changed), skipped, pruned)
+    assert list(store.time) == [row[1] for row in rows[2:]], list(store.time)
+    assert store.temp[0] == 300.0 and store.temp[-1] == 289.0, list(store.temp)
+    changed, skipped, pruned = store.sync(rows[:2], 2 * 10800)  # Past rows are neither written nor held
+    assert (len(changed), skipped, pruned) == (0, 2, 0), (len(changed), skipped, pruned)
+
+
+def bench_forecast_ingest(locations=50, slots=100):
+    check_store_sync()
+    use_memory_database()
+    seed_locations(locations)
+    now = int(time()) + 10800
+    passes = (('first ingest', 0.0), ('unchanged ingest', 0.0), ('changed ingest', 0.5))
+    for label, warmer in passes:  # Only the last pass has rows that differ from what is already stored
+        payloads = [forecast_json(location_id, slots, now, warmer) for location_id in range(locations)]
+        start = time()
+        syncs = [database.Forecast.save_all_to_db(payload) for payload in payloads]
+        wait_for_writes()
+        elapsed = time() - start
+        emit('{name:<32} {rows} rows in {elapsed:.3f} s   {rate:10.0f} rows/s   '
+             '{written} written {skipped} skipped',
+             name='save_all_to_db ' + label, rows=locations * slots, elapsed=elapsed,
+             rate=locations * slots / elapsed, written=sum(sync.written for sync in syncs),
+             skipped=sum(sync.skipped for sync in syncs))
+        expected = 0 if label == 'unchanged ingest' else locations * slots
+        assert sum(sync.written for sync in syncs) == expected, label
+        assert sum(sync.skipped for sync in syncs) == locations * slots - expected, label
+    rows, = database._db.select('''SELECT COUNT(*) FROM forecast''', after_writes=True)
+    assert rows[0] == locations * slots, rows  # The table has what the stores have
+
+
+def bench_query_paths(locations=100, slots=2000, repeat=20):
+    use_memory_database()
+    seed_locations(locations)
+    start = int(time()) - slots // 2 * 10800  # Half of every location's history is in the past
+    for location_id in range(locations):
+        seed_forecasts(location_id, slots, start)
+    wait_for_writes()
+    emit('{rows} forecast rows seeded', rows=locations * slots)
+    location = database.Location.from_id(locations // 2)
+    report('Forecast.get_current_forecast', timed(lambda: database.Forecast.get_current_forecast(location.id), repeat))
+    report('Location.forecasts', timed(lambda: location.forecasts, repeat))
+    upserts = cycle([forecast_json(location.id, 40, int(time()) + 10800, warmer) for warmer in (0.5, 1.0)])
+    report('save_all_to_db (40 row refresh)', timed(lambda: (database.Forecast.save_all_to_db(next(upserts)),
+                                                             wait_for_writes()), repeat))
+
+
+def bench_screen_round_trips(slots=40):
+    """Reads what SimpleWeatherScreen and MenuScreen read, counting the selects they wait for."""
+    use_memory_database()
+    seed_locations(10)
+    database.Forecast.save_all_to_db(forecast_json(0, slots, int(time())))
+    round_trips = database._db.round_trips
+    start = time()
+    location = database.Location.from_id(0)
+    for forecast in location.forecasts:
+        forecast.symbol
+        repr(forecast)
+    emit('{name:<32} {count:4} round trips   {elapsed:8.3f} ms', name='simple screen data',
+         count=database._db.round_trips - round_trips, elapsed=(time() - start) * 1000)
+    round_trips = database._db.round_trips
+    start = time()
+    for location in database.Location.all_locations():
+        location.get_current_weather.symbol
+    emit('{name:<32} {count:4} round trips   {elapsed:8.3f} ms', name='menu screen data',
+         count=database._db.round_trips - round_trips, elapsed=(time() - start) * 1000)
+    from kivy.clock import Clock
+    round_trips = database._db.round_trips
+    start = time()
+    delivered = []
+    database.on_main_thread(database.Location.all_with_current_forecast(), delivered.append)
+    queued = time() - start
+    while not delivered:
+        Clock.tick()
+    for location, forecast in delivered[0]:
+        forecast.symbol
+    emit('{name:<32} {count:4} round trips   {elapsed:8.3f} ms   {queued:8.3f} ms blocking',
+         name='menu screen data (joined)', count=database._db.round_trips - round_trips,
+         elapsed=(time() - start) * 1000, queued=queued * 1000)
+
+
+def bench_refresh(counts=(5, 20, 50), delay=0.05):
+    from kivy.clock import Clock
+    server = FakeOpenWeatherMap(delay)
+    database.URLS['get_forecasts'] = server.url + '/forecast?id={id}&APPID={appid}'
+    for locations in counts:
+        for max_in_flight in (locations, database.MAX_REQUESTS_IN_FLIGHT):  # All at once like before, then bounded
+            use_memory_database()
+            seed_locations(locations)
+            server.most_active = 0
+            start = time()
+            refresher = database.ForecastRefresher(range(locations), max_in_flight=max_in_flight)
+            refresher.start()
+            while not refresher.finished:
+                Clock.tick()  # UrlRequest hands its result back through the Clock
+            wait_for_writes()
+            emit('refresh {locations:3} locations, {limit:3} in flight   {elapsed:7.3f} s   '
+                 'at most {active} requests at once',
+                 locations=locations, limit=max_in_flight, elapsed=time() - start,
+                 active=server.most_active)
+    server.shutdown()
+
+
+def bench_scheduler(locations=20, failing=5, delay=0.05):
+    """Two scheduler checks in a row: the first refreshes everything, the second only what failed and isn't
+    backing off."""
+    from kivy.clock import Clock
+    server = FakeOpenWeatherMap(delay)
+    server.failing = set(range(failing))
+    database.URLS['get_forecasts'] = server.url + '/forecast?id={id}&APPID={appid}'
+    use_memory_database()
+    seed_locations(locations)
+    scheduler = database.RefreshScheduler(interval=3600)
+    scheduler.start()
+    for check in ('first check', 'second check'):
+        server.requests = 0
+        start = time()
+        scheduler.check()
+        while scheduler.event is None:  # The next check is scheduled once this one has nothing left to do
+            Clock.tick()
+        stats = scheduler.stats
+        emit('scheduler {check:<14} {requests:3} requests   {elapsed:7.3f} s   {refreshed} '
+             'refreshed {failed} failed {backing_off} backing off   p50 {p50:.3f} s',
+             check=check, requests=server.requests, elapsed=time() - start,
+             p50=stats['latency_p50'], **stats)
+    scheduler.pause()
+    server.shutdown()
+
+
+def bench_location_search(repeat=20, delay=0.05):
+    """Time until results arrive for a query sent to the endpoint, then repeated from the in-memory cache."""
+    from kivy.clock import Clock
+    import location_search
+    server = FakeOpenWeatherMap(delay)
+    database.URLS['find_location'] = server.url + '/find?q={location}&APPID={appid}'
+    database.OPENWEATHERKEY = 'benchmark key'  # api_keys.py may only have the placeholder
+    use_memory_database()
+    results = []
+    search = location_search.LocationSearch(lambda query, locations, final: final and results.append(locations))
+
+    def search_and_wait(query):
+        del results[:]
+        search.search_now(query)
+        while not results:
+            Clock.tick()
+        assert results[0], query  # A failed request also ends the search, with no locations
+    queries = cycle(['town' + str(count) for count in range(repeat)])
+    report('LocationSearch (endpoint)', timed(lambda: search_and_wait(next(queries)), repeat))
+    assert search.hits == 0 and search.misses == repeat, search.stats
+    report('LocationSearch (cached)', timed(lambda: search_and_wait(next(queries)), repeat))
+    assert search.hits == repeat, search.stats
+    server.shutdown()
+
+
+def bench_gazetteer(cities=200000, repeat=200):
+    """Offline lookups in a city list the size of OpenWeatherMap's."""
+    directory = tempfile.mkdtemp()
+    try:
+        source = os.path.join(directory, 'city.list.json')
+        with open(source, 'w') as output:
+            json.dump([{'id': city, 'name': 'Town' + str(city), 'country': 'GB',
+                        'coord': {'lat': city * 7 % 17000 / 100.0 - 85, 'lon': city * 13 % 36000 / 100.0 - 180}}
+                       for city in range(cities)], output)
+        start = time()
+        imported = gazetteer.build_gazetteer(source, os.path.join(directory, 'gazetteer.db'))
+        emit('gazetteer built from {count} cities in {elapsed:.3f} s   {size:.0f} KiB',
+             count=imported, elapsed=time() - start,
+             size=os.path.getsize(os.path.join(directory, 'gazetteer.db')) / 1024.0)
+        cities_db = gazetteer.Gazetteer(os.path.join(directory, 'gazetteer.db'))
+        report('Gazetteer.search', timed(lambda: cities_db.search('town123'), repeat))
+        report('Gazetteer.nearest', timed(lambda: cities_db.nearest(51.5, -0.12, 10), repeat))
+        cities_db.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+def daily_per_object(forecasts, timezone):
+    # What the screens would do without analytics, a Forecast at a time
+    days = OrderedDict()
+    for forecast in forecasts:
+        day = (forecast.time + timezone * 3600) // analytics.SECONDS_PER_DAY
+        celsius = forecast.temp - analytics.ABSOLUTE_ZERO
+        summary = days.setdefault(day, {'min': celsius, 'max': celsius, 'total': 0.0, 'count': 0, 'wet': 0,
+                                        'wind': 0.0, 'gust': 0.0, 'conditions': {}})
+        summary['min'] = min(summary['min'], celsius)
+        summary['max'] = max(summary['max'], celsius)
+        summary['total'] += celsius
+        summary['count'] += 1
+        summary['wet'] += forecast.symbol_number // 100 in analytics.WET_CONDITIONS
+        summary['wind'] += forecast.wind_speed
+        summary['gust'] = max(summary['gust'], forecast.wind_speed)
+        summary['conditions'][forecast.symbol_number] = summary['conditions'].get(forecast.symbol_number, 0) + 1
+        forecast.pressure * 100, forecast.wind_speed * 3.6  # The per row conversions
+    return [(day, summary['min'], summary['max'], summary['total'] / summary['count'],
+             max(summary['conditions'], key=summary['conditions'].get), summary['wet'] / float(summary['count']),
+             summary['wind'] / summary['count'], summary['gust']) for day, summary in days.items()]
+
+
+def check_analytics(forecasts, store, timezone):
+    """ForecastTable's days against the per object loop's, raises AssertionError if they differ."""
+    expected = daily_per_object(forecasts, timezone)
+    days = analytics.ForecastTable(store).days()
+    assert len(days) == len(expected), (len(days), len(expected))
+    for day, (number, temp_min, temp_max, temp_mean, condition, wet, wind_mean, wind_max) in zip(days, expected):
+        assert (day.day, day.condition) == (number, condition), (day, number, condition)
+        figures = (day.temp_min, day.temp_max, day.temp_mean, day.precipitation, day.wind_mean, day.wind_max)
+        assert all(abs(a - b) < 1e-9 for a, b in zip(figures, (temp_min, temp_max, temp_mean, wet, wind_mean,
+                                                                  wind_max))), (day, expected)
+
+
+def bench_analytics(counts=(40, 1000, 100000), repeat=5):
+    """Daily aggregates and conversions over a location's history, per Forecast object and with NumPy."""
+    for slots in counts:
+        payload = forecast_json(0, slots, 1500000000)
+        rows = [(0, slot['dt'], slot['main']['temp'], slot['main']['pressure'], slot['main']['humidity'],
+                 slot['clouds']['all'], slot['wind']['speed'], slot['wind']['deg'], slot['weather'][0]['id'])
+                for slot in payload['list']]
+        store = database.ForecastStore(0, rows, 1)
+        forecasts = store.forecasts()
+        check_analytics(forecasts, store, 1)
+        report(Formatter().format('per object loop {slots:6} rows', slots=slots),
+               timed(lambda: daily_per_object(forecasts, 1), repeat))
+        report(Formatter().format('ForecastTable   {slots:6} rows', slots=slots),
+               timed(lambda: analytics.ForecastTable(store).days(), repeat))
+
+
+def bench_symbols(slots=1000, repeat=20):
+    """The symbols a SimpleWeatherScreen shows, worked out per Forecast against read from the store."""
+    use_memory_database()
+    seed_locations(1)
+    seed_forecasts(0, slots, int(time()))
+    wait_for_writes()
+    location = database.Location.from_id(0)
+    rows = list(database._db.select('''SELECT * FROM forecast WHERE location_id = 0 ORDER BY time'''))
+    report(Formatter().format('symbols from Forecast rows {slots}', slots=slots),
+           timed(lambda: [database.Forecast(*row).symbol for row in rows], repeat))
+    location.forecasts
+    report(Formatter().format('symbols from ForecastStore {slots}', slots=slots),
+           timed(lambda: [forecast.symbol for forecast in location.store.forecasts()], repeat))
+
+
+def bench_screen_build(counts=(40, 400, 1000)):
+    from kivy.clock import Clock
+    from kivy.lang import Builder
+    import main
+    Builder.load_file('weather.kv')
+    for slots in counts:
+        use_memory_database()
+        seed_locations(1)
+        database.Forecast.save_all_to_db(forecast_json(0, slots, int(time())))
+        location = database.Location.from_id(0)
+        location.forecasts  # So both runs start with the same warm caches
+
+        tracemalloc.start()
+        start = time()
+        screen = main.SimpleWeatherScreen(location)
+        Clock.tick()  # Lets the RecycleView lay out and create its visible rows
+        elapsed = time() - start
+        memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        rows = len(screen.simple_weather_scroll.layout_manager.children)
+        emit('SimpleWeatherScreen {slots:5} forecasts   {elapsed:8.3f} s   {memory:8.0f} KiB   '
+             '{rows:5} row widgets', slots=slots, elapsed=elapsed, memory=memory / 1024.0,
+             rows=rows)
+
+        tracemalloc.start()
+        start = time()
+        widgets = [main.ForecastRow(**row) for row in screen.forecast_rows(location.forecasts, screen.table)
+                   if 'viewclass' not in row]  # The old eager build
+        elapsed = time() - start
+        memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        emit('eager widget list   {slots:5} forecasts   {elapsed:8.3f} s   {memory:8.0f} KiB   '
+             '{rows:5} row widgets', slots=slots, elapsed=elapsed, memory=memory / 1024.0,
+             rows=len(widgets))
+
+
+def bench_mixed_load(locations=50, slots=400, reads=200):
+    """UI reads while a forecast refresh keeps the writer busy, with and without the read pool."""
+    for read_connections in (0, database.READ_CONNECTIONS):
+        directory = tempfile.mkdtemp()
+        try:
+            use_database(os.path.join(directory, 'weather.db'), read_connections)
+            seed_locations(locations)
+            payloads = [forecast_json(location_id, slots, int(time())) for location_id in range(locations)]
+            for payload in payloads:
+                database.Forecast.save_all_to_db(payload)
+            wait_for_writes()
+            stop = []
+
+            changed = [forecast_json(location_id, slots, int(time()), 0.5) for location_id in range(locations)]
+            batches = cycle([changed, payloads])  # Alternating temperatures so every pass rewrites its rows
+
+            def refresh():  # One batch after another, like a refresh with responses arriving steadily
+                while not stop:
+                    with database._db.transaction() as transaction:
+                        for payload in next(batches)[:database.REFRESH_BATCH_SIZE]:
+                            database.Forecast.save_all_to_db(payload, transaction)
+                    database._db.flush().result()
+            writer = Thread(target=refresh)
+            writer.start()
+            location = database.Location.from_id(locations // 2)
+            timings = timed(lambda: (location.forecasts, database.Forecast.get_current_forecast(location.id)), reads)
+            stop.append(True)
+            writer.join()
+            emit('mixed load, {count} read connections   p50 {p50:8.3f} ms   p99 {p99:8.3f} ms',
+                 count=read_connections, p50=timings[len(timings) // 2] * 1000,
+                 p99=timings[int(len(timings) * 0.99)] * 1000)
+            database._db.close(wait=True)
+        finally:
+            shutil.rmtree(directory)
+
+
+class DictForecast:
+    """Forecast as it was before __slots__, for comparison."""
+    def __init__(self, forecast_id, location_id, time, temp, pressure, humidity, clouds, windspeed, winddirection,
+                 symbol):
+        self.id = forecast_id or None
+        self.location_id = location_id
+        self.time = time
+        self.temp = temp
+        self.pressure = pressure
+        self.humidity = humidity
+        self.clouds = clouds
+        self.wind_speed = windspeed
+        self.wind_direction = winddirection
+        self.symbol_number = symbol
+
+
+def bench_instrumentation(rows=2000, repeat=200, locations=20, delay=0.05):
+    """What recording costs the database thread, then what a refresh records."""
+    from kivy.clock import Clock
+    command = '''INSERT INTO forecast(location_id, time, temp, pressure, humidity, clouds, windspeed, ''' \
+              '''winddirection, symbol) VALUES (?,?,?,?,?,?,?,?,?)'''
+    was_enabled = instrumentation.enabled
+    try:
+        for enabled in (False, True):
+            instrumentation.enable(enabled)
+            instrumentation.reset()
+            use_memory_database()
+            seed_locations(1)
+            start = time()
+            for row in range(rows):
+                database._db.execute(command, (0, row, 280.0, 1012, 80, 40, 3.5, 180, 500))
+            wait_for_writes()
+            elapsed = time() - start
+            label = 'on' if enabled else 'off'
+            emit('{name:<32} {rows} rows in {elapsed:.3f} s   {rate:10.0f} rows/s',
+                 name='queued inserts, recording ' + label, rows=rows, elapsed=elapsed, rate=rows / elapsed)
+            report('select round trip, recording ' + label,
+                   timed(lambda: list(database._db.select('''SELECT 1''')), repeat))
+        instrumentation.reset()
+        server = FakeOpenWeatherMap(delay)
+        database.URLS['get_forecasts'] = server.url + '/forecast?id={id}&APPID={appid}'
+        use_memory_database()
+        seed_locations(locations)
+        refresher = database.ForecastRefresher(range(locations))
+        refresher.start()
+        while not refresher.finished:
+            Clock.tick()
+        wait_for_writes()
+        server.shutdown()
+        for name, summary in sorted(instrumentation.snapshot().items()):
+            scale, unit = (1, 'bytes') if name.endswith('.bytes') else (1000, 'ms')
+            emit('{name:<32} {count:6}   p50 {p50:10.3f}   p99 {p99:10.3f}   max {max:10.3f} {unit}',
+                 name=name, count=summary['count'], p50=summary['p50'] * scale, p99=summary['p99'] * scale,
+                 max=summary['max'] * scale, unit=unit)
+    finally:
+        instrumentation.enable(was_enabled)
+        instrumentation.reset()
+
+
+def table_sizes(file):
+    # Bytes of the pages in use by each table and its indexes, freed pages left out
+    db = sqlite3.connect(file)
+    try:
+        return dict(db.execute('''SELECT tbl_name, SUM(pgsize) FROM dbstat JOIN sqlite_master USING (name) '''
+                               '''GROUP BY tbl_name''').fetchall())
+    finally:
+        db.close()
+
+
+def compact_backlog(compactor):
+    # Runs steps back to back until one finds less than a full batch and schedules the next look interval later
+    from kivy.clock import Clock
+    compactor.start()
+    while compactor.event is None or compactor.event.timeout < compactor.interval:
+        Clock.tick()
+
+
+def bench_history(locations=20, days=60, repeat=20):
+    """Rolling days of past forecasts up into forecast_daily: how long the backlog takes, the space it saves and
+    reading a location's history back."""
+    directory = tempfile.mkdtemp()
+    try:
+        file = os.path.join(directory, 'weather.db')
+        use_database(file)
+        seed_locations(locations)
+        start = int(time()) - days * 86400
+        for location_id in range(locations):
+            seed_forecasts(location_id, days * 8 + 40, start)  # Every 3 hours from days ago to 5 days ahead
+        wait_for_writes()
+        before = table_sizes(file)
+        command = '''SELECT * FROM forecast WHERE location_id = ? AND time < ? ORDER BY time ASC'''
+        report('history from raw forecasts', timed(lambda: list(database._db.select(command, (7, int(time())))),
+                                                   repeat))
+        compactor = history.Compactor(step_delay=0, interval=3600)
+        started = time()
+        compact_backlog(compactor)
+        wait_for_writes()
+        emit('{name:<32} {compacted} forecasts into {days} days in {steps} steps   {elapsed:7.3f} s',
+             name='compact backlog', elapsed=time() - started, **compactor.stats)
+        compactor.pause()
+        after = table_sizes(file)
+        emit('{name:<32} {before:8} bytes before   {after:8} bytes after   forecast_daily {daily} bytes, '
+             '{per_day:.1f} a day',
+             name='forecast tables', before=before['forecast'],
+             after=after['forecast'] + after['forecast_daily'], daily=after['forecast_daily'],
+             per_day=after['forecast_daily'] / float(compactor.days))
+        report('history.daily', timed(lambda: history.daily(7), repeat))
+        database._db.close(wait=True)
+    finally:
+        shutil.rmtree(directory)
+
+
+def measure(build):
+    tracemalloc.start()
+    kept = build()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return kept, memory
+
+
+def bench_forecast_memory(locations=36, days=42):
+    """Weeks of 3 hourly history for dozens of locations held as objects and as columns."""
+    slots = days * 8
+    rows = [[(location_id, 1500000000 + slot * 10800, 270.5 + slot % 20, 1012.0, 80, 40, 3.5, 180.0, 500)
+             for slot in range(slots)] for location_id in range(locations)]
+    results = [
+        ('dict objects', measure(lambda: [[DictForecast(None, *row) for row in location] for location in rows])[1]),
+        ('__slots__ objects', measure(lambda: [[database.Forecast(None, *row) for row in location]
+                                               for location in rows])[1]),
+        ('ForecastStore', measure(lambda: [database.ForecastStore(location[0][0], location) for location in rows])[1]),
+    ]
+    for name, memory in results:
+        emit('{count} forecasts as {name:<20} {memory:10.0f} KiB   {ratio:5.1f}x',
+             count=locations * slots, name=name, memory=memory / 1024.0,
+             ratio=results[0][1] / float(memory))
+    use_memory_database()
+    seed_locations(1)
+    start = int(time()) + 10800
+    seed_forecasts(0, slots, start)
+    wait_for_writes()
+    location = database.Location.from_id(0)
+    report('Location.forecasts (first, loads)', timed(lambda: location.forecasts, 1))
+    report('Location.forecasts (from store)', timed(lambda: location.forecasts, 20))
+    refreshes = cycle([forecast_json(0, 40, start + (slots - 20) * 10800, warmer)  # Half updates, half new slots
+                       for warmer in (0.5, 1.0)])
+    report('ForecastStore refresh of 40 rows', timed(lambda: database.Forecast.save_all_to_db(next(refreshes)), 20))
+
+
+BENCHMARKS = [bench_startup, bench_select_latency, bench_select_round_trip, bench_write_throughput, bench_forecast_ingest,
+              bench_query_paths, bench_screen_round_trips, bench_forecast_memory, bench_refresh, bench_scheduler,
+              bench_location_search, bench_gazetteer, bench_analytics, bench_symbols, bench_mixed_load,
+              bench_screen_build, bench_instrumentation, bench_history]
+
+
+def main(arguments=None):
+    names = [benchmark.__name__[len('bench_'):] for benchmark in BENCHMARKS]
+    parser = argparse.ArgumentParser(description='Benchmarks for the weather database, all of them by default.')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help=Formatter().format('any of {names}', names=', '.join(names)))
+    parser.add_argument('--json', metavar='FILE', help='also write every result to FILE')
+    started = time()
+    try:
+        arguments = parser.parse_args(arguments)
+        for name in arguments.benchmarks:
+            if name not in names:
+                parser.error(Formatter().format('no benchmark called {name}', name=name))
+        for benchmark in BENCHMARKS:
+            if not arguments.benchmarks or benchmark.__name__[len('bench_'):] in arguments.benchmarks:
+                running[0] = benchmark.__name__
+                benchmark()
+    finally:
+        database._db.close(wait=True)  # Its thread would keep the process alive
+    if arguments.json:
+        with open(arguments.json, 'w') as output:
+            json.dump({'started': started, 'elapsed': time() - started, 'python': sys.version.split()[0],
+                       'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(), 'results': RESULTS},
+                      output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -33,7 +33,7 @@ version = 1.0
 
 # (list) Application requirements
 # comma seperated e.g. requirements = sqlite3,kivy
-requirements = sqlite3, openssl, requests, kivy
+requirements = python3, sqlite3, openssl, requests, kivy, numpy
 
 # (str) Custom source folders for requirements
 # Sets custom source for any requirements with recipes
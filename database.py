@@ -1,19 +1,24 @@
-from datetime import datetime, date
-import json
+from array import array
+import asyncio
+from bisect import bisect_left
+from collections import deque, namedtuple
+from concurrent.futures import Future
+from functools import partial
+import instrumentation
+from itertools import count
+from kivy.clock import Clock
 from kivy.logger import Logger, LOG_LEVELS
 from kivy.network.urlrequest import UrlRequest
 import os
+from queue import Empty, PriorityQueue, Queue
+import random
+import response_cache
 import sqlite3
+import storage
 from string import Formatter
-from time import ctime, sleep, time
+from time import ctime, time
 from threading import Thread, Event
-
-try:
-    from urllib.request import urlopen
-    from queue import Queue, PriorityQueue
-except ImportError:
-    from urllib import urlopen
-    from Queue import Queue, PriorityQueue
+from urllib.request import pathname2url
 
 try:
     from api_keys import GOOGLEKEY, OPENWEATHERKEY
@@ -37,19 +42,62 @@ weather_icon_lookup = {
     905: 'e',
     906: 'i'
 }
+NIGHT_SYMBOL = 'o'
+UNKNOWN_SYMBOL = 'l'  # N/A
 URLS = {
     'find_location': 'http://api.openweathermap.org/data/2.5/find?q={location}&type=like&APPID={appid}',
     'get_forecasts': 'http://api.openweathermap.org/data/2.5/forecast?id={id}&APPID={appid}',
     'timezone': 'https://maps.googleapis.com/maps/api/timezone/json?location={lat:.2f},{lon:.2f}&timestamp={time}&key={APPID}'
 }
+Sync = namedtuple('Sync', 'location_id written skipped pruned')  # What save_all_to_db did for one location
+CLOSE_PRIORITY = 99  # Lower than any job so everything already queued runs before the thread stops
+# Each entry upgrades the schema by one version, the version a database is at is kept in PRAGMA user_version.
+# Only ever append to this list, databases already on a phone have run the earlier entries.
+MIGRATIONS = [
+    # 1: forecast gets UNIQUE (location_id, time) so refreshes can upsert. SQLite can't add a constraint to an
+    # existing table so it is rebuilt, keeping the newest row of any duplicates. The constraint's index also
+    # serves every lookup of a location's forecasts by time.
+    ['''CREATE TABLE "forecast_new" (forecast_id INTEGER PRIMARY KEY, location_id INTEGER, time INTEGER, temp REAL, pressure INTEGER, humidity INTEGER, clouds INTEGER, windspeed REAL, winddirection INTEGER, symbol INTEGER, UNIQUE (location_id, time), FOREIGN KEY (location_id) REFERENCES location (location_id) DEFERRABLE INITIALLY DEFERRED)''',
+     '''INSERT INTO forecast_new SELECT * FROM forecast WHERE forecast_id IN (SELECT MAX(forecast_id) FROM forecast GROUP BY location_id, time)''',
+     '''DROP TABLE forecast''',
+     '''ALTER TABLE forecast_new RENAME TO forecast'''],
+    # 2: remove_old_forecasts filters on time alone and the menu lists locations by date added
+    ['''CREATE INDEX forecast_time ON forecast (time)''',
+     '''CREATE INDEX location_dateadded ON location (dateadded)'''],
+    # 3: offsets from the Google Timezone API, keyed on coordinates rounded to TIMEZONE_PRECISION
+    ['''CREATE TABLE timezone (lat REAL, lon REAL, timezone REAL, PRIMARY KEY (lat, lon))'''],
+    # 4: a row per location and local day for forecasts too old to keep, see history.py. The columns are integers
+    # scaled by history.TEMP_SCALE and WIND_SCALE, and WITHOUT ROWID keeps the rows in the primary key's B-tree
+    # instead of a second index next to the table
+    ['''CREATE TABLE forecast_daily (location_id INTEGER, day INTEGER, samples INTEGER, temp_min INTEGER, temp_max INTEGER, temp_mean INTEGER, pressure INTEGER, humidity INTEGER, clouds INTEGER, wind_mean INTEGER, wind_max INTEGER, wind_direction INTEGER, symbol INTEGER, wet INTEGER, PRIMARY KEY (location_id, day)) WITHOUT ROWID'''],
+    # 5: when each location's forecasts were last fetched, for RefreshScheduler. Existing locations start from an
+    # estimate, a fresh response reaches 5 days (40 three hourly slots) ahead of when it was fetched
+    ['''CREATE TABLE refresh (location_id INTEGER PRIMARY KEY, refreshed INTEGER)''',
+     '''INSERT INTO refresh SELECT location_id, MAX(time) - 432000 FROM forecast GROUP BY location_id'''],
+]
+TIMEZONE_PRECISION = 1  # Decimal places, about 11 km which is far smaller than any timezone
+REFRESH_BATCH_SIZE = 10  # Forecast responses written to the database in one transaction
+MAX_REQUESTS_IN_FLIGHT = 4  # Forecast requests sent at the same time during a refresh
+FLUSH_INTERVAL = 0.5  # Longest time in seconds the worker keeps a transaction open while jobs keep arriving
+READ_CONNECTIONS = 2  # Read only connections answering selects next to the writer, see ReadPool
+DATABASE_FILE = 'weather.db'
+REFRESH_AGE = 3 * 60 * 60  # Forecasts older than this are refreshed, OpenWeatherMap only updates every 3 hours
+REFRESH_CHECK_INTERVAL = 5 * 60  # Seconds between looking for stale locations
+REFRESH_JITTER = 10 * 60  # Each location goes stale up to this many seconds late, so they don't all refresh at once
+RETRY_DELAY = 60  # Seconds before retrying a location whose refresh failed, doubled after every further failure
+MAX_RETRY_DELAY = 60 * 60
 
 
 class MultiThreadedWeatherDatabase(Thread):
-    def __init__(self, file):
+    def __init__(self, file, read_connections=READ_CONNECTIONS):
         super(MultiThreadedWeatherDatabase, self).__init__()
         self.file = file
+        self.read_connections = read_connections if file != ':memory:' else 0  # Nothing else can open :memory:
+        self.readers = None  # The ReadPool, started once the tables are up to date
         self.queue = PriorityQueue()
         self.event = Event()
+        self.round_trips = 0  # Number of selects the caller had to wait for, see main.log_build
+        self.order = count()  # Keeps jobs of the same priority in the order they were queued
         self.create_tables = False
         if not os.path.isfile(file):
             self.create_tables = True
@@ -57,96 +105,589 @@ class MultiThreadedWeatherDatabase(Thread):
 
     def run(self):
         super(MultiThreadedWeatherDatabase, self).run()
-        db = sqlite3.connect(self.file)
+        db = sqlite3.connect(self.file, isolation_level=None)  # Transactions are handled by the worker loop
         cursor = db.cursor()
+        storage.use_wal(cursor)
         if self.create_tables:
-            self.create_all_tables()
-        while True:
-            if self.queue.empty():
-                sleep(0.1)  # So the thread doesnt use all of the processor
+            self.create_all_tables(cursor)
+        self.upgrade_tables(cursor)
+        if self.read_connections:
+            self.readers = ReadPool(self.file, self.read_connections)
+        running = True
+        while running:
+            job = self.queue.get()  # Blocks until there is a job to do
+            cursor.execute('BEGIN')
+            started = time()
+            committed = []  # (future, result) of flushes and batches, which are only done once they're committed
+            while True:
+                priority, order, sql, arg, result, queued = job
+                if sql is None:  # Sentinel put on the queue by close()
+                    running = False
+                    break
+                if sql == '__flush__':
+                    committed.append((result, None))
+                else:
+                    error = self.run_queued(cursor, sql, arg, result, queued, committed)
+                    if not db.in_transaction:  # SQLite rolled the whole transaction back, as it does on a full disk
+                        Logger.error(Formatter().format('Database: {error}, the jobs before it were rolled back too',
+                                                        error=error))
+                        self.settle(committed, error)
+                        committed = []
+                        cursor.execute('BEGIN')
+                if time() - started > FLUSH_INTERVAL:
+                    break
+                try:
+                    job = self.queue.get_nowait()  # Group everything already waiting into this transaction
+                except Empty:
+                    break
+            try:
+                cursor.execute('COMMIT')
+            except sqlite3.Error as error:
+                Logger.error(Formatter().format('Database: {error} committing', error=error))
+                if db.in_transaction:
+                    cursor.execute('ROLLBACK')
+                self.settle(committed, error)
                 continue
-            job, sql, arg, result = self.queue.get_nowait()
-            if sql == '__close__':
-                break
-            if arg is None:
-                arg = ''
-            cursor.execute(sql, arg)
-            db.commit()
-            if result:
-                for rec in cursor:
-                    result.put(rec)
-                result.put('__last__')
+            instrumentation.record_since('db.transaction', started)
+            self.settle(committed)
+        if self.readers is not None:
+            self.readers.close()
         db.close()
         self.event.set()
 
+    @staticmethod
+    def settle(committed, error=None):
+        # Done once the transaction is committed, or with the error if it was rolled back
+        for future, result in committed:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    @staticmethod
+    def run_queued(cursor, sql, arg, result, queued, committed=None):
+        # run_job, timing how long the job waited in its queue and how long it ran for when instrumentation is on
+        if not instrumentation.enabled:
+            return MultiThreadedWeatherDatabase.run_job(cursor, sql, arg, result, committed)
+        kind = 'batch' if sql == '__batch__' else sql.split(None, 1)[0].lower()
+        began = time()
+        instrumentation.record('db.' + kind + '.wait', began - queued)
+        error = MultiThreadedWeatherDatabase.run_job(cursor, sql, arg, result, committed)
+        instrumentation.record_since('db.' + kind + '.run', began)
+        return error
+
+    @staticmethod
+    def run_job(cursor, sql, arg, result, committed=None):
+        # Returns the error if the job failed. A batch's result waits in committed until the commit
+        try:
+            if sql == '__batch__':
+                cursor.execute('SAVEPOINT batch')
+                try:
+                    for statement, statement_arg, many in arg:
+                        if many:
+                            cursor.executemany(statement, statement_arg)
+                        else:
+                            cursor.execute(statement, statement_arg or '')
+                except sqlite3.Error:
+                    if cursor.connection.in_transaction:  # Unless SQLite has already rolled everything back
+                        cursor.execute('ROLLBACK TO batch')  # Undo the whole batch but keep the outer transaction
+                        cursor.execute('RELEASE batch')
+                    raise
+                cursor.execute('RELEASE batch')
+            else:
+                cursor.execute(sql, arg or '')
+        except sqlite3.Error as error:
+            if result is None:
+                Logger.error(Formatter().format('Database: {error} in {sql}', error=error, sql=sql))
+            else:
+                result.set_exception(error)
+            return error
+        if result is None:
+            return None
+        if sql == '__batch__' and committed is not None:
+            committed.append((result, cursor.fetchall()))
+        else:
+            result.set_result(cursor.fetchall())  # The whole result set is handed over at once
+
     def execute(self, sql, args=None, res=None, priority=2):
-        self.queue.put_nowait((priority, sql, args, res))
+        self.queue.put_nowait((priority, next(self.order), sql, args, res, time()))
 
-    def select(self, sql, args=None, priority=2):
-        res = Queue()
-        self.execute(sql, args, res, priority)
-        while True:
-            rec = res.get()
-            if rec == '__last__':
-                break
+    def transaction(self, priority=2):
+        return Transaction(self, priority)
+
+    def select_async(self, sql, args=None, priority=2, after_writes=False):
+        """Returns straight away with a concurrent.futures.Future of the list of rows.
+
+        Selects go to the ReadPool when there is one and see what has been committed, so they aren't held up behind
+        writes. Pass after_writes to run on the writer after everything already queued, to read your own writes.
+        Use on_main_thread to get a callback on the Kivy main thread or awaitable to await it from asyncio.
+        """
+        future = Future()
+        if self.readers is not None and not after_writes:
+            self.readers.submit(sql, args, future)
+        else:
+            self.execute(sql, args, future, priority)
+        return future
+
+    def select(self, sql, args=None, priority=2, after_writes=False):
+        # Blocks the caller until the query has run
+        for rec in self.wait(self.select_async(sql, args, priority, after_writes)):
             yield rec
 
-    def close(self):
-        self.execute('__close__')
+    def flush(self, priority=2):
+        # A future which is done once everything queued before it at the same or a higher priority is committed
+        future = Future()
+        self.execute('__flush__', res=future, priority=priority)
+        return future
+
+    def wait(self, future):
+        if not future.done():
+            self.round_trips += 1
+        return future.result()
+
+    def close(self, wait=False):
+        self.execute(None, priority=CLOSE_PRIORITY)
+        if wait:
+            self.event.wait()
 
-    def create_all_tables(self):
+    @staticmethod
+    def create_all_tables(cursor):
+        # The tables as they were before any migration, upgrade_tables brings them up to date
         command1 = '''CREATE TABLE location (location_id INTEGER PRIMARY KEY , town TEXT, country TEXT, lat REAL, lon REAL, dateadded INTEGER, timezone INTEGER)'''
-        self.execute(command1)
+        cursor.execute(command1)
         command2 = '''CREATE TABLE "forecast" (forecast_id INTEGER PRIMARY KEY, location_id INTEGER, time INTEGER, temp REAL, pressure INTEGER, humidity INTEGER, clouds INTEGER, windspeed REAL, winddirection INTEGER, symbol INTEGER, FOREIGN KEY (location_id) REFERENCES location (location_id) DEFERRABLE INITIALLY DEFERRED)'''
-        self.execute(command2)
+        cursor.execute(command2)
+
+    @staticmethod
+    def upgrade_tables(cursor):
+        version = cursor.execute('''PRAGMA user_version''').fetchone()[0]
+        for version, migration in enumerate(MIGRATIONS[version:], version + 1):
+            cursor.execute('BEGIN')  # A migration and its version number are applied together or not at all
+            for command in migration:
+                cursor.execute(command)
+            cursor.execute(Formatter().format('''PRAGMA user_version = {version}''', version=version))
+            cursor.execute('COMMIT')
+            Logger.info(Formatter().format('Database: upgraded to schema version {version}', version=version))
 
 
-    def remove_old_forecasts(self):
-        command = '''DELETE FROM forecast WHERE forecast.time < STRFTIME('%s', 'now')'''
-        self.execute(command)
+class ReadPool:
+    """Read only connections to the database file, each on its own thread, sharing one queue of selects.
 
+    In WAL mode they read the last committed state while MultiThreadedWeatherDatabase keeps writing.
+    """
+    def __init__(self, file, size):
+        self.queue = Queue()
+        self.uri = 'file:' + pathname2url(os.path.abspath(file)) + '?mode=ro'
+        self.threads = [Thread(target=self.run) for _ in range(size)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
 
-_db = MultiThreadedWeatherDatabase('weather.db')
+    def run(self):
+        db = sqlite3.connect(self.uri, uri=True, isolation_level=None)
+        cursor = db.cursor()
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            sql, arg, future, queued = job
+            MultiThreadedWeatherDatabase.run_queued(cursor, sql, arg, future, queued)
+        db.close()
 
+    def submit(self, sql, args, future):
+        self.queue.put((sql, args, future, time()))
 
-def get_symbol_from_number(num, forecast=None):
-    # http://openweathermap.org/weather-conditions
-    if isinstance(num, int):
-        num = str(num)
-    if forecast is not None:
-        localtime = ((datetime.fromtimestamp(forecast.time).hour + forecast.location.timezone) % 24)
-        if not 6 < localtime < 20:
-            #print('location is nighttime')  # Something is wrong with this line
-            return 'o'
-    try:
-        return weather_icon_lookup[int(num)]
-    except KeyError:
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+
+
+def on_main_thread(future, on_success, on_failure=None):
+    # Calls on_success(result) on the Kivy main thread once the future is done. Errors are logged and passed to
+    # on_failure(error) instead, if there is one
+    def done(future):
+        Clock.schedule_once(lambda dt: deliver(future))  # Runs on the worker thread, Clock hands over to the main one
+
+    def deliver(future):
         try:
-            return weather_icon_lookup[int(num[0])]
-        except KeyError:
-            text = Formatter().format('The weather symbol could not be found. Symbol: {num}', num=num)
-            Logger.warn(text)
-            return 'l'  # N/A
+            result = future.result()
+        except Exception as error:
+            Logger.error(Formatter().format('Database: {error}', error=error))
+            if on_failure is not None:
+                on_failure(error)
+            return
+        on_success(result)
+    future.add_done_callback(done)
+
+
+def awaitable(future):
+    # For asyncio code, the future must be awaited from inside the running event loop
+    return asyncio.wrap_future(future)
+
+
+def map_future(future, function):
+    # A future of function(result), function runs on whichever thread completes the first future
+    mapped = Future()
+
+    def done(future):
+        try:
+            mapped.set_result(function(future.result()))
+        except Exception as error:
+            mapped.set_exception(error)
+    future.add_done_callback(done)
+    return mapped
+
+
+def completed_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
 
 
-def get_timezone(lat, lon):
+class Transaction:
+    """Collects statements and queues them as one job which is committed or rolled back as a whole.
+
+    with _db.transaction() as transaction:
+        transaction.execute(sql, args)
+
+    future is done once the statements have been committed, or has the error if they were rolled back.
+    """
+    def __init__(self, db, priority=2):
+        self.db = db
+        self.priority = priority
+        self.statements = []
+        self.future = Future()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def execute(self, sql, args=None):
+        self.statements.append((sql, args, False))
+
+    def executemany(self, sql, args):
+        self.statements.append((sql, list(args), True))
+
+    def commit(self):
+        # Once per transaction, it's done with after that
+        self.future.add_done_callback(log_failure)
+        if self.statements:
+            self.db.execute('__batch__', self.statements, self.future, priority=self.priority)
+        else:
+            self.future.set_result([])
+        self.statements = []
+        return self.future
+
+
+def log_failure(future):
+    if future.exception() is not None:
+        Logger.error(Formatter().format('Database: {error}', error=future.exception()))
+
+
+def default_database():
+    return MultiThreadedWeatherDatabase(DATABASE_FILE)
+
+
+_db = storage.Lazy(default_database, wait=True)
+
+
+def symbol_table():
+    # The symbol for every condition code from 0 to 999, the exact code's if it has one else its group's
+    # http://openweathermap.org/weather-conditions
+    return ''.join(weather_icon_lookup.get(code, weather_icon_lookup.get(int(str(code)[0]), UNKNOWN_SYMBOL))
+                   for code in range(1000))
+
+
+SYMBOLS = symbol_table()
+
+
+def get_symbol_from_number(num, forecast=None):
+    # Pass the forecast to get the night symbol when it's dark at the forecast's location
+    if forecast is not None and not 6 < local_hour(forecast.time, forecast.location.timezone) < 20:
+        return NIGHT_SYMBOL
+    num = int(num)
+    if 0 <= num < len(SYMBOLS):
+        return SYMBOLS[num]
+    Logger.warn(Formatter().format('The weather symbol could not be found. Symbol: {num}', num=num))
+    return UNKNOWN_SYMBOL
+
+
+def local_hour(time, timezone):
+    return (time + int(timezone * 3600)) % 86400 // 3600
+
+
+def local_day(time, timezone):
+    # Days since 1 January 1970 at the location
+    return (time + int(timezone * 3600)) // 86400
+
+
+def day_label(day, today):
+    # today is local_day of now at the same location
+    if day == today:
+        return 'Today'
+    elif day == today + 1:
+        return 'Tomorrow'
+    return weekdays[(day + 4) % 7]  # 1 January 1970 was a Thursday
+
+
+def estimate_timezone(lon):
+    # Offline guess from the longitude, every 15 degrees is an hour. Ignores political boundaries and daylight saving
+    return int(round(lon / 15.0))
+
+
+def get_timezone(lat, lon, on_success):
+    """Calls on_success(timezone) on the Kivy main thread with the offset in hours, from the timezone table or else
+    from Google. Neither blocks the caller.
+
+    Nothing is called if Google can't be reached, callers should use estimate_timezone until then.
+    """
+    lat, lon = round(lat, TIMEZONE_PRECISION), round(lon, TIMEZONE_PRECISION)
+    command = '''SELECT timezone FROM timezone WHERE lat = ? AND lon = ?'''
+    on_main_thread(_db.select_async(command, (lat, lon)), partial(on_cached_timezone, lat, lon, on_success))
+
+
+def on_cached_timezone(lat, lon, on_success, rows):
+    # Google is only asked when the timezone table doesn't have the place yet
+    if rows:
+        on_success(rows[0][0])
+        return
     url = Formatter().format(URLS['timezone'], lat=lat, lon=lon, time=int(time()), APPID=GOOGLEKEY)
-    data = json.loads(urlopen(url).read().decode('utf-8'))
+    UrlRequest(url, on_success=partial(on_timezone, lat, lon, on_success, time()),
+               on_failure=on_timezone_failure, on_error=on_timezone_failure)
+
+
+def on_timezone(lat, lon, on_success, started, req, data):
+    instrumentation.record_since('http.timezone.latency', started)
     if data['status'] != 'OK':
-        raise Exception
-    timezone = data['rawOffset'] / 3600
+        on_timezone_failure(req, data['status'])
+        return
+    timezone = data['rawOffset'] / 3600.0
     # Get rawOffset from google in seconds so divide by 3600 to get in hours
-    return timezone
+    _db.execute('''INSERT OR REPLACE INTO timezone VALUES (?,?,?)''', (lat, lon, timezone))
+    on_success(timezone)
 
 
-def get_forecasts(location_id, on_success):
+def on_timezone_failure(req, result):
+    Logger.warn(Formatter().format('Timezone lookup failed, using estimate: {result}', result=result))
+
+
+def get_forecasts(location_id, on_success, on_failure=None, on_error=None):
     url = URLS['get_forecasts'].format(id=location_id, appid=OPENWEATHERKEY).replace(' ', '%20')
-    UrlRequest(url, on_success=on_success)
+    response_cache._cache.request(url, 'get_forecasts', on_success, on_failure=on_failure, on_error=on_error)
+
+
+class ForecastRefresher:
+    """Fetches the forecasts for a list of locations without flooding the network or the database.
+
+    OpenWeatherMap's multi-city group endpoint only returns the current weather, so every location still needs its
+    own forecast request. At most max_in_flight of them are out at once and the responses are saved batch_size at a
+    time, each batch in one transaction. Cached responses are revalidated, never used as they are, so what's saved
+    is as new as the server's. Callbacks arrive on the Kivy main thread.
+    """
+    def __init__(self, location_ids, batch_size=REFRESH_BATCH_SIZE, max_in_flight=MAX_REQUESTS_IN_FLIGHT,
+                 on_complete=None):
+        self.pending = list(location_ids)
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.on_complete = on_complete
+        self.in_flight = 0
+        self.received = []
+        self.refreshed = []  # Location ids whose forecasts have been saved
+        self.failed = []
+        self.sent = {}  # Location id: time its request went out
+        self.latencies = []  # Seconds each answered request took
+        self.written = 0  # Forecast rows inserted or changed
+        self.skipped = 0  # Forecast rows which were already saved or in the past
+        self.pruned = 0  # Past forecasts dropped from the stores, history.Compactor archives them
+
+    @property
+    def finished(self):
+        return not self.pending and self.in_flight == 0
+
+    def start(self):
+        if self.finished:
+            self.complete()
+        else:
+            self.fill()
 
+    def fill(self):
+        while self.pending and self.in_flight < self.max_in_flight:
+            location_id = self.pending.pop(0)
+            self.in_flight += 1
+            location = Location._identity_map.get(location_id)
+            if location is not None and location.store is None:
+                location.load_store_async()  # So it's ready to compare with when the response arrives
+            self.sent[location_id] = time()
+            get_forecasts(location_id, partial(self.on_success, location_id),
+                          on_failure=partial(self.on_failure, location_id),
+                          on_error=partial(self.on_failure, location_id))
 
-def refresh_forecasts():
-    for location in Location.all_locations():
-        get_forecasts(location.id, add_forecast)
+    def on_success(self, location_id, req, data):
+        if data['cod'] != 404:
+            self.received.append(data)
+        self.request_done(location_id)
+
+    def on_failure(self, location_id, req, result):
+        Logger.warn(Formatter().format('Refreshing forecasts for {location_id} failed: {result}',
+                                       location_id=location_id, result=result))
+        self.failed.append(location_id)
+        self.request_done(location_id)
+
+    def request_done(self, location_id):
+        self.latencies.append(time() - self.sent.pop(location_id))
+        self.in_flight -= 1
+        if len(self.received) >= self.batch_size or self.finished:
+            self.flush()
+        if self.finished:
+            self.complete()
+        else:
+            self.fill()
+
+    def flush(self):
+        if self.received:
+            with _db.transaction() as transaction:
+                for data in self.received:
+                    sync = Forecast.save_all_to_db(data, transaction)
+                    if sync is not None:
+                        self.refreshed.append(sync.location_id)
+                        self.written += sync.written
+                        self.skipped += sync.skipped
+                        self.pruned += sync.pruned
+        self.received = []
+
+    def complete(self):
+        Logger.info(Formatter().format('Refresh: {written} forecasts written, {skipped} skipped, {pruned} pruned, '
+                                       '{failed} locations failed', written=self.written, skipped=self.skipped,
+                                       pruned=self.pruned, failed=len(self.failed)))
+        if self.on_complete is not None:  # Once the forecasts are committed, so they can be read back
+            on_main_thread(_db.flush(), lambda result: self.on_complete(self))
+
+
+class ClockTask:
+    """Background work run on the Kivy Clock, the subclass's run is called delay seconds after schedule(delay).
+
+    start runs it straight away, call pause and resume from the App's on_pause and on_resume. A run already under
+    way when it's paused finishes, but nothing new is started.
+    """
+    def __init__(self, interval):
+        self.interval = interval  # Seconds until the next run once there's nothing left to do
+        self.paused = True
+        self.event = None
+
+    def start(self):
+        self.paused = False
+        self.schedule(0)
+
+    def pause(self):
+        self.paused = True
+        if self.event is not None:
+            self.event.cancel()
+            self.event = None
+
+    resume = start
+
+    def schedule(self, delay):
+        if self.event is not None:
+            self.event.cancel()
+        self.event = Clock.schedule_once(self.run, delay)
+
+    def run(self, dt=None):
+        raise NotImplementedError
+
+    def on_failure(self, error):
+        # For on_main_thread, tried again at the next interval rather than never
+        if not self.paused:
+            self.schedule(self.interval)
+
+
+class RefreshScheduler(ClockTask):
+    """Refreshes each location's forecasts in the background once they are older than max_age.
+
+    A location's age is from when its forecasts were last fetched, which save_all_to_db keeps in the refresh table so
+    it survives restarts. Every interval seconds the stale locations are handed to a ForecastRefresher. Each location
+    gets a random extra age of up to jitter seconds so locations added together don't keep refreshing together, and a
+    location that failed waits RETRY_DELAY, doubling with every failure in a row, before it's tried again.
+    """
+    def __init__(self, max_age=REFRESH_AGE, interval=REFRESH_CHECK_INTERVAL, jitter=REFRESH_JITTER,
+                 on_refreshed=None):
+        super(RefreshScheduler, self).__init__(interval)
+        self.max_age = max_age
+        self.jitter = jitter
+        self.on_refreshed = on_refreshed  # Called with the ForecastRefresher after every refresh
+        self.refresher = None
+        self.offsets = {}  # Location id: its jitter in seconds
+        self.failures = {}  # Location id: failed refreshes in a row
+        self.retry_at = {}  # Location id: time before which it isn't refreshed again
+        self.refreshes = 0
+        self.refreshed = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=100)  # Seconds taken by the most recent forecast requests
+
+    @property
+    def running(self):
+        return self.refresher is not None and not self.refresher.finished
+
+    @property
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {'refreshes': self.refreshes, 'refreshed': self.refreshed, 'failed': self.failed,
+                'backing_off': len(self.retry_at),
+                'latency_mean': sum(latencies) / len(latencies) if latencies else None,
+                'latency_p50': latencies[len(latencies) // 2] if latencies else None,
+                'latency_max': latencies[-1] if latencies else None}
+
+    def check(self, dt=None):
+        self.event = None
+        if self.paused or self.running:
+            return
+        command = '''SELECT location.location_id, refresh.refreshed FROM location LEFT JOIN refresh ON ''' \
+                  '''refresh.location_id = location.location_id'''
+        on_main_thread(_db.select_async(command, after_writes=True), self.refresh_stale, self.on_failure)
+
+    run = check
+
+    def stale(self, rows, now):
+        location_ids = []
+        for location_id, refreshed in rows:
+            offset = self.offsets.setdefault(location_id, random.uniform(0, self.jitter))
+            if now < self.retry_at.get(location_id, 0):
+                continue
+            if refreshed is None or now - refreshed > self.max_age + offset:
+                location_ids.append(location_id)
+        return location_ids
+
+    def refresh_stale(self, rows):
+        if self.paused or self.running:
+            return
+        location_ids = self.stale(rows, time())
+        if not location_ids:
+            self.schedule(self.interval)
+            return
+        Logger.info(Formatter().format('RefreshScheduler: refreshing {count} stale locations',
+                                       count=len(location_ids)))
+        self.refreshes += 1
+        self.refresher = ForecastRefresher(location_ids, on_complete=self.on_complete)
+        self.refresher.start()
+
+    def on_complete(self, refresher):
+        now = time()
+        self.latencies.extend(refresher.latencies)
+        self.refreshed += len(refresher.refreshed)
+        self.failed += len(refresher.failed)
+        for location_id in refresher.refreshed:
+            self.failures.pop(location_id, None)
+            self.retry_at.pop(location_id, None)
+        for location_id in refresher.failed:
+            failures = self.failures[location_id] = self.failures.get(location_id, 0) + 1
+            delay = min(RETRY_DELAY * 2 ** (failures - 1), MAX_RETRY_DELAY)
+            self.retry_at[location_id] = now + random.uniform(delay / 2.0, delay)  # Jittered like the refreshes
+        if self.on_refreshed is not None:
+            self.on_refreshed(refresher)
+        if not self.paused:
+            self.schedule(self.interval)
 
 
 def location_from_json(raw_json, count):
@@ -165,14 +706,12 @@ def location_from_json(raw_json, count):
     return Location(location_id, town, country, lat, lon, time(), 0)
 
 
-def add_forecast(req, data):
-    if data['cod'] != 404:
-        Forecast.save_all_to_db(data)
-
-
 class Forecast:
+    __slots__ = ('id', 'location_id', 'time', 'temp', 'pressure', 'humidity', 'clouds', 'wind_speed', 'wind_direction',
+                 'symbol_number', 'hour', 'day', 'glyph')
+
     def __init__(self, forecast_id, location_id, time, temp, pressure, humidity, clouds, windspeed, winddirection,
-                 symbol):
+                 symbol, hour=None, day=None, glyph=None):
         self.id = forecast_id or None
         self.location_id = location_id
         self.time = time
@@ -183,48 +722,75 @@ class Forecast:
         self.wind_speed = windspeed
         self.wind_direction = winddirection
         self.symbol_number = symbol
+        # Local hour, local day and symbol, filled in by ForecastStore or else worked out on first use
+        self.hour = hour
+        self.day = day
+        self.glyph = glyph
 
     def __repr__(self):
         return Formatter().format('<Forecast {town}, {time}>', town=self.location.town, time=ctime(self.time))
 
     @classmethod
     def get_current_forecast(cls, location_id):
-        command = '''SELECT * FROM forecast WHERE location_id = ? AND ''' \
-                  '''ABS(forecast.time - STRFTIME('%s', 'now')) < (10799) AND forecast.time > STRFTIME('%s','NOW');'''
-        try:
-            return Forecast(*next(_db.select(command, (location_id,))))
-        except StopIteration:
+        return _db.wait(cls.get_current_forecast_async(location_id))
+
+    @classmethod
+    def get_current_forecast_async(cls, location_id):
+        # The next 3 hour slot, written as a range on time so the (location_id, time) index answers it
+        command = '''SELECT * FROM forecast WHERE location_id = ? AND forecast.time > STRFTIME('%s','NOW') AND ''' \
+                  '''forecast.time < STRFTIME('%s', 'now') + 10799 ORDER BY forecast.time ASC LIMIT 1;'''
+        return map_future(_db.select_async(command, (location_id,)), partial(cls.current_from_rows, location_id))
+
+    @classmethod
+    def current_from_rows(cls, location_id, rows):
+        if not rows:
             Logger.error('Couldn\'t find any forecast for {}'.format(location_id))
             return Forecast.not_available(location_id)
+        return Forecast(*rows[0])
 
     @classmethod
     def not_available(cls, location_id):
         return cls(0, location_id, 0, 0, 0, 0, 0, 0, 0, '000')
 
     @staticmethod
-    def save_all_to_db(data):
+    def save_all_to_db(data, transaction=None):
+        """Writes the forecasts in a response which are new or changed and drops past ones from the location's store.
+
+        The response is compared with the location's ForecastStore, loading it first if needed. Pass a transaction
+        to save several locations' forecasts in one commit. Returns a Sync with the counts, or None if not saved.
+        """
         Logger.debug(str(data))
         try:
 
             location = Location.from_id(data['city']['id'])
-        except KeyError:
+        except (KeyError, IndexError):  # IndexError if the location was deleted while its forecasts were downloading
             Logger.log(LOG_LEVELS['critical'], 'We seem to have some massive issue with something')
             return
-        command = "INSERT OR REPLACE INTO forecast(forecast_id, location_id, time, temp, pressure, humidity, clouds, " \
-                  "windspeed, winddirection, symbol) VALUES "
-        for forecast in data['list']:
-            forecast_time = forecast['dt']
-            temp = forecast['main']['temp']
-            pressure = forecast['main']['pressure']
-            humidity = forecast['main']['humidity']
-            clouds = forecast['clouds']['all']
-            windspeed = forecast['wind']['speed']
-            winddirection = forecast['wind']['deg']
-            symbol = forecast['weather'][0]['id']
-            command += Formatter().format(
-                "((SELECT forecast_id FROM forecast WHERE location_id={location_id} AND time={time}),{location_id},{time},{temp},{pressure},{humidity},{clouds},{windspeed},{winddirection},{symbol}),",
-                location_id = location.id, time=forecast_time, temp=temp, pressure=pressure, humidity=humidity, clouds=clouds, windspeed=windspeed, winddirection=winddirection, symbol=symbol)
-        _db.execute(command[:-1])
+        command = "INSERT INTO forecast(location_id, time, temp, pressure, humidity, clouds, windspeed, winddirection, " \
+                  "symbol) VALUES (?,?,?,?,?,?,?,?,?) ON CONFLICT (location_id, time) DO UPDATE SET temp=excluded.temp, " \
+                  "pressure=excluded.pressure, humidity=excluded.humidity, clouds=excluded.clouds, " \
+                  "windspeed=excluded.windspeed, winddirection=excluded.winddirection, symbol=excluded.symbol"
+        rows = [(location.id, forecast['dt'], forecast['main']['temp'], forecast['main']['pressure'],
+                 forecast['main']['humidity'], forecast['clouds']['all'], forecast['wind']['speed'],
+                 forecast['wind']['deg'], forecast['weather'][0]['id']) for forecast in data['list']]
+        store = location.store if location.store is not None else _db.wait(location.load_store_async())
+        now = int(time())
+        changed, skipped, pruned = store.sync(rows, now)
+        if transaction is None:
+            with _db.transaction() as transaction:  # Every forecast for the location is written or none are
+                Forecast.write_sync(transaction, command, location, store, changed, now)
+        else:
+            Forecast.write_sync(transaction, command, location, store, changed, now)
+        return Sync(location.id, len(changed), skipped, pruned)
+
+    @staticmethod
+    def write_sync(transaction, command, location, store, changed, now):
+        # Past forecasts stay in the table until history.Compactor rolls them up
+        if changed:
+            transaction.executemany(command, changed)
+        transaction.execute('''INSERT OR REPLACE INTO refresh VALUES (?,?)''', (location.id, now))
+        # The store already has the changes, if the transaction is rolled back it's loaded again from the table
+        transaction.future.add_done_callback(partial(location.check_store, store))
 
     @property
     def location(self):
@@ -232,10 +798,107 @@ class Forecast:
 
     @property
     def symbol(self):
-        return get_symbol_from_number(self.symbol_number, self)
+        if self.glyph is None:
+            self.glyph = get_symbol_from_number(self.symbol_number, self)
+        return self.glyph
+
+
+class ForecastStore:
+    """One location's forecasts held column by column in arrays, sorted by time.
+
+    Loaded from the database once and then kept up to date by save_all_to_db. A forecast costs 8 bytes a column
+    here instead of a Forecast object per row. The local hour, local day and symbol of every forecast are worked out
+    as it's added, and again for all of them if the location's timezone changes.
+    """
+    __slots__ = ('location_id', 'time', 'temp', 'pressure', 'humidity', 'clouds', 'wind_speed', 'wind_direction',
+                 'symbol_number', 'timezone', 'hour', 'day', 'glyph')
+    columns = __slots__[1:9]  # In the order of the forecast table, after forecast_id and location_id
+    typecodes = ('q', 'd', 'd', 'q', 'q', 'd', 'd', 'l')
+    derived = __slots__[10:]
+
+    def __init__(self, location_id, rows=(), timezone=0):
+        # rows are (location_id, time, temp, pressure, humidity, clouds, windspeed, winddirection, symbol) by time
+        self.location_id = location_id
+        self.timezone = timezone
+        for column, typecode in zip(self.columns, self.typecodes):
+            setattr(self, column, array(typecode))
+        self.hour = array('b')
+        self.day = array('l')
+        self.glyph = []  # One character strings, which Python only keeps one copy of
+        for row in rows:
+            self.append(row)
+
+    def __len__(self):
+        return len(self.time)
+
+    def __getitem__(self, index):
+        return Forecast(None, self.location_id, *[getattr(self, column)[index] for column in self.columns],
+                        hour=self.hour[index], day=self.day[index], glyph=self.glyph[index])
+
+    def derive(self, time, symbol_number):
+        hour = local_hour(time, self.timezone)
+        if not 6 < hour < 20:
+            glyph = NIGHT_SYMBOL
+        elif 0 <= symbol_number < len(SYMBOLS):
+            glyph = SYMBOLS[symbol_number]
+        else:
+            glyph = UNKNOWN_SYMBOL
+        return hour, local_day(time, self.timezone), glyph
+
+    def set_timezone(self, timezone):
+        self.timezone = timezone
+        derived = [self.derive(time, symbol_number) for time, symbol_number in zip(self.time, self.symbol_number)]
+        self.hour = array('b', [hour for hour, day, glyph in derived])
+        self.day = array('l', [day for hour, day, glyph in derived])
+        self.glyph = [glyph for hour, day, glyph in derived]
+
+    def forecasts(self):
+        return [self[index] for index in range(len(self))]
+
+    @staticmethod
+    def values(row):
+        return (row[1], row[2] or 0, row[3] or 0, int(row[4] or 0), int(row[5] or 0), row[6] or 0, row[7] or 0,
+                int(row[8] or 0))
+
+    def append(self, row):
+        values = self.values(row)
+        for column, value in zip(self.columns, values):
+            getattr(self, column).append(value)
+        for column, value in zip(self.derived, self.derive(values[0], values[-1])):
+            getattr(self, column).append(value)
+
+    def sync(self, rows, stale_before):
+        """Brings the store up to date with rows and drops forecasts older than stale_before.
+
+        Returns the rows which were new or different, how many rows were already held unchanged or stale, and how
+        many forecasts were dropped.
+        """
+        changed = []
+        for row in rows:
+            values = self.values(row)
+            if values[0] < stale_before:
+                continue
+            index = bisect_left(self.time, values[0])
+            if index < len(self.time) and self.time[index] == values[0]:
+                if all(getattr(self, column)[index] == value for column, value in zip(self.columns, values)):
+                    continue
+                for column, value in zip(self.columns + self.derived, values + self.derive(values[0], values[-1])):
+                    getattr(self, column)[index] = value
+            else:
+                for column, value in zip(self.columns + self.derived, values + self.derive(values[0], values[-1])):
+                    getattr(self, column).insert(index, value)
+            changed.append(row)
+        pruned = bisect_left(self.time, stale_before)
+        if pruned:
+            for column in self.columns + self.derived:
+                del getattr(self, column)[:pruned]
+        return changed, len(rows) - len(changed), pruned
 
 
 class Location:
+    __slots__ = ('id', 'town', 'country', 'lat', 'lon', 'date_added', 'timezone', 'store')
+    _identity_map = {}  # location_id -> Location, so each saved location is only read from the database once
+
     def __init__(self, location_id, town, country, lat, lon, date_added, timezone):
         self.id = location_id
         self.town = town
@@ -244,41 +907,128 @@ class Location:
         self.lon = lon
         self.date_added = date_added
         self.timezone = timezone
+        self.store = None  # ForecastStore, loaded the first time the forecasts are asked for
 
     def __repr__(self):
         return Formatter().format('<Location: {town}>', town=self.town)  # For debugging properties
 
+    @classmethod
+    def from_row(cls, row):
+        try:
+            return cls._identity_map[row[0]]
+        except KeyError:
+            return cls._identity_map.setdefault(row[0], cls(*row))  # Atomic, the rows may arrive on the worker thread
+
+    @classmethod
+    def clear_cache(cls):
+        cls._identity_map.clear()
+
     @classmethod
     def from_id(cls, location_id):
-        command = '''SELECT * FROM location WHERE location_id = ?'''
+        return _db.wait(cls.from_id_async(location_id))
+
+    @classmethod
+    def from_id_async(cls, location_id):
         try:
-            return cls(*next(_db.select(command, (location_id,))))
-        except StopIteration:
+            return completed_future(cls._identity_map[location_id])
+        except KeyError:
+            pass
+        command = '''SELECT * FROM location WHERE location_id = ?'''
+        return map_future(_db.select_async(command, (location_id,)), partial(cls.from_rows, location_id))
+
+    @classmethod
+    def from_rows(cls, location_id, rows):
+        if not rows:
             raise IndexError(Formatter().format('location_id {location_id} is not in database', location_id=location_id))
+        return cls.from_row(rows[0])
 
     @classmethod
     def all_locations(cls):
+        return _db.wait(cls.all_locations_async())
+
+    @classmethod
+    def all_locations_async(cls):
         command = '''SELECT * FROM location ORDER BY dateadded ASC'''
-        return [cls(*location) for location in _db.select(command)]
+        return map_future(_db.select_async(command), lambda rows: [cls.from_row(location) for location in rows])
+
+    @classmethod
+    def all_with_current_forecast(cls, after_writes=False):
+        """A future of a (location, current forecast) pair for every location, from a single query."""
+        command = '''SELECT location.*, forecast.* FROM location LEFT JOIN forecast ON forecast.forecast_id = ''' \
+                  '''(SELECT forecast_id FROM forecast WHERE forecast.location_id = location.location_id AND ''' \
+                  '''forecast.time > STRFTIME('%s','NOW') AND forecast.time < STRFTIME('%s', 'now') + 10799 ''' \
+                  '''ORDER BY forecast.time ASC LIMIT 1) ORDER BY location.dateadded ASC'''
+        return map_future(_db.select_async(command, after_writes=after_writes), cls.current_forecasts_from_rows)
+
+    @classmethod
+    def current_forecasts_from_rows(cls, rows):
+        locations = []
+        for row in rows:
+            location = cls.from_row(row[:7])
+            if row[7] is None:  # No forecast for the next 3 hours
+                forecast = Forecast.not_available(location.id)
+            else:
+                forecast = Forecast(*row[7:])
+            locations.append((location, forecast))
+        return locations
 
     @property
     def get_current_weather(self):
         return Forecast.get_current_forecast(self.id)
 
-    def save_to_db(self):
+    def save_to_db(self, on_timezone=None):
+        # Saved straight away with an estimated timezone, the real one is filled in when it arrives.
+        # on_timezone(location) is called if that changes the timezone.
         command = '''INSERT INTO location VALUES (?,?,?,?,?,?,?)'''
-        timezone = get_timezone(self.lat, self.lon)
-        _db.execute(command, (self.id, self.town, self.country, self.lat, self.lon, int(time()), timezone))
+        self.timezone = estimate_timezone(self.lon)
+        self.date_added = int(time())
+        _db.execute(command, (self.id, self.town, self.country, self.lat, self.lon, self.date_added, self.timezone))
+        Location._identity_map[self.id] = self
+        get_timezone(self.lat, self.lon, partial(self.set_timezone, on_timezone))
+
+    def set_timezone(self, on_timezone, timezone):
+        if timezone == self.timezone:
+            return
+        self.timezone = timezone
+        if self.store is not None:
+            self.store.set_timezone(timezone)  # Its hours, days and night symbols move with it
+        _db.execute('''UPDATE location SET timezone = ? WHERE location_id = ?''', (timezone, self.id))
+        if on_timezone is not None:
+            on_timezone(self)
+
+    def check_store(self, store, future):
+        # Called with the future of a transaction that store's changes were written in
+        if future.exception() is not None and self.store is store:
+            self.store = None
 
     def remove_from_db(self):
-        command1 = '''DELETE FROM forecast WHERE location_id==?'''
-        _db.execute(command1, (self.id,), priority=1)
-        # Next time: location has an attribute of status only display if status is true then I can keep them in database
-        # if someone deletes by mistake
-        command2 = '''DELETE FROM location WHERE location_id = ?'''
-        _db.execute(command2, (self.id,), priority=1)
+        with _db.transaction(priority=1) as transaction:
+            command1 = '''DELETE FROM forecast WHERE location_id==?'''
+            transaction.execute(command1, (self.id,))
+            transaction.execute('''DELETE FROM forecast_daily WHERE location_id = ?''', (self.id,))
+            transaction.execute('''DELETE FROM refresh WHERE location_id = ?''', (self.id,))
+            # Next time: location has an attribute of status only display if status is true then I can keep them in database
+            # if someone deletes by mistake
+            command2 = '''DELETE FROM location WHERE location_id = ?'''
+            transaction.execute(command2, (self.id,))
+        Location._identity_map.pop(self.id, None)
 
     @property
     def forecasts(self):
-        command = '''SELECT * FROM forecast WHERE location_id=? ORDER BY time ASC'''
-        return [Forecast(*f) for f in _db.select(command, (self.id,))]
+        return _db.wait(self.forecasts_async())
+
+    def forecasts_async(self):
+        if self.store is not None:
+            return completed_future(self.store.forecasts())
+        return map_future(self.load_store_async(), ForecastStore.forecasts)
+
+    def load_store_async(self):
+        # Only forecasts still to come, the past ones in the table are history
+        command = '''SELECT * FROM forecast WHERE location_id=? AND time >= ? ORDER BY time ASC'''
+        # after_writes so a refresh which is queued but not committed yet isn't missed
+        return map_future(_db.select_async(command, (self.id, int(time())), after_writes=True), self.load_store)
+
+    def load_store(self, rows):
+        if self.store is None:  # Unless a refresh got there first
+            self.store = ForecastStore(self.id, [row[1:] for row in rows], self.timezone)
+        return self.store
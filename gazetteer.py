@@ -0,0 +1,122 @@
+"""Offline town lookups from OpenWeatherMap's city list.
+
+Build the database once with ``python gazetteer.py city.list.json.gz``, the
+list is at http://bulk.openweathermap.org/sample/. Without gazetteer.db the
+app searches online only.
+"""
+import database
+import gzip
+import json
+from math import asin, cos, radians, sin, sqrt
+import os
+import sqlite3
+import sys
+from string import Formatter
+from time import time
+from urllib.request import pathname2url
+
+GAZETTEER_FILE = 'gazetteer.db'
+MAX_RESULTS = 10
+NEAREST_START = 0.5  # Degrees either side of a point searched first, doubled until enough towns are found
+NEAREST_LIMIT = 16  # Widest search in degrees either side, there's nothing near a point in the middle of an ocean
+
+
+def name_key(name):
+    return ' '.join(name.lower().split())
+
+
+def distance(lat1, lon1, lat2, lon2):
+    # Great circle distance in km
+    lat1, lon1, lat2, lon2 = radians(lat1), radians(lon1), radians(lat2), radians(lon2)
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 6371 * 2 * asin(sqrt(a))
+
+
+def lon_ranges(west, east):
+    # A box from west to east split in two where it crosses the antimeridian, so Fiji is near Samoa
+    if east - west >= 360:
+        return [(-180, 180)]
+    if west < -180:
+        return [(west + 360, 180), (-180, east)]
+    if east > 180:
+        return [(west, 180), (-180, east - 360)]
+    return [(west, east)]
+
+
+def build_gazetteer(source, file=GAZETTEER_FILE):
+    """Imports OpenWeatherMap's city.list.json, gzipped or not, into a new gazetteer database.
+
+    Returns the number of towns in it, which leaves out entries without a name.
+    """
+    opener = gzip.open if source.endswith('.gz') else open
+    with opener(source, 'rb') as cities:
+        cities = json.loads(cities.read().decode('utf-8'))
+    if os.path.exists(file):
+        os.remove(file)
+    db = sqlite3.connect(file)
+    # Name lookups are whole name prefixes, so a B-tree on the folded name is enough and doesn't depend on FTS being
+    # compiled into the phone's SQLite
+    db.execute('''CREATE TABLE city (city_id INTEGER PRIMARY KEY, name TEXT, country TEXT, lat REAL, lon REAL, key TEXT)''')
+    db.executemany('''INSERT OR REPLACE INTO city VALUES (?,?,?,?,?,?)''',
+                   ((city['id'], city['name'], city['country'], city['coord']['lat'], city['coord']['lon'],
+                     name_key(city['name'])) for city in cities if city['name']))
+    db.execute('''CREATE INDEX city_key ON city (key)''')
+    db.execute('''CREATE INDEX city_position ON city (lat, lon)''')
+    db.commit()
+    db.execute('''VACUUM''')
+    imported = db.execute('''SELECT COUNT(*) FROM city''').fetchone()[0]
+    db.close()
+    return imported
+
+
+def open_gazetteer(file=GAZETTEER_FILE):
+    # None when the gazetteer hasn't been built
+    if not os.path.exists(file):
+        return None
+    return Gazetteer(file)
+
+
+class Gazetteer:
+    """Read only town lookups by name prefix or position, answered from disk in well under a millisecond."""
+    def __init__(self, file):
+        self.db = sqlite3.connect('file:' + pathname2url(os.path.abspath(file)) + '?mode=ro', uri=True)
+
+    def search(self, prefix, limit=MAX_RESULTS):
+        key = name_key(prefix)
+        if not key:
+            return []
+        # A range rather than LIKE so the index is used whatever the collation
+        command = '''SELECT city_id, name, country, lat, lon FROM city WHERE key >= ? AND key < ? ORDER BY key LIMIT ?'''
+        return [self.location(row) for row in self.db.execute(command, (key, key + u'\U0010ffff', limit))]
+
+    def nearest(self, lat, lon, limit=1):
+        command = '''SELECT city_id, name, country, lat, lon FROM city WHERE lat BETWEEN ? AND ? AND ''' \
+                  '''lon BETWEEN ? AND ?'''
+        width = NEAREST_START
+        while True:
+            lon_width = min(width / max(cos(radians(lat)), 0.01), 180)  # Degrees of longitude shrink towards the poles
+            rows = []
+            for west, east in lon_ranges(lon - lon_width, lon + lon_width):
+                rows.extend(self.db.execute(command, (lat - width, lat + width, west, east)))
+            if len(rows) >= limit or width >= NEAREST_LIMIT:
+                break
+            width *= 2
+        rows.sort(key=lambda row: distance(lat, lon, row[3], row[4]))
+        return [self.location(row) for row in rows[:limit]]
+
+    @staticmethod
+    def location(row):
+        city_id, name, country, lat, lon = row
+        return database.Location(city_id, name, country, lat, lon, time(), 0)
+
+    def close(self):
+        self.db.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('Usage: python gazetteer.py city.list.json.gz')
+        sys.exit(1)
+    print(Formatter().format('{count} cities imported into {file}', count=build_gazetteer(sys.argv[1]),
+                             file=GAZETTEER_FILE))
+    database._db.close()
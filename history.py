@@ -0,0 +1,143 @@
+"""Past forecasts, kept as one compact row per location and local day.
+
+Forecasts stay in the forecast table at full resolution until RAW_DAYS whole
+local days have gone by, then Compactor rolls them up into forecast_daily and
+deletes them. So the forecast table only ever holds a few days per location
+while the history goes back as far as the app has been refreshing.
+"""
+from collections import namedtuple
+from itertools import groupby
+from kivy.logger import Logger
+from string import Formatter
+from time import time
+import analytics
+import database
+import instrumentation
+
+RAW_DAYS = 2  # Whole local days past forecasts are kept as they are before being rolled up
+COMPACT_BATCH = 400  # Forecasts rolled up per step, about 50 location days
+COMPACT_STEP_DELAY = 0.5  # Seconds between steps while there is a backlog, so the UI gets the database in between
+COMPACT_INTERVAL = 60 * 60  # Seconds between looking for forecasts which have become old enough
+COMPACT_PRIORITY = 3  # Queued behind anything the screens ask for
+TEMP_SCALE = 10  # forecast_daily temperatures are tenths of a degree Celsius
+WIND_SCALE = 10  # and wind speeds tenths of a metre per second
+DailyForecast = namedtuple('DailyForecast', 'location_id day samples temp_min temp_max temp_mean pressure humidity '
+                                            'clouds wind_mean wind_max wind_direction condition precipitation')
+# A day compacted in two steps, which only happens when a location's timezone changed in between, is merged with
+# the means weighted by how many forecasts each part had, rounded like rollups rather than truncated
+UPSERT = '''INSERT INTO forecast_daily VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?) ON CONFLICT (location_id, day) DO UPDATE SET samples = samples + excluded.samples, temp_min = MIN(temp_min, excluded.temp_min), temp_max = MAX(temp_max, excluded.temp_max), temp_mean = CAST(ROUND((temp_mean * samples + excluded.temp_mean * excluded.samples) * 1.0 / (samples + excluded.samples)) AS INTEGER), pressure = CAST(ROUND((pressure * samples + excluded.pressure * excluded.samples) * 1.0 / (samples + excluded.samples)) AS INTEGER), humidity = CAST(ROUND((humidity * samples + excluded.humidity * excluded.samples) * 1.0 / (samples + excluded.samples)) AS INTEGER), clouds = CAST(ROUND((clouds * samples + excluded.clouds * excluded.samples) * 1.0 / (samples + excluded.samples)) AS INTEGER), wind_mean = CAST(ROUND((wind_mean * samples + excluded.wind_mean * excluded.samples) * 1.0 / (samples + excluded.samples)) AS INTEGER), wind_max = MAX(wind_max, excluded.wind_max), wind_direction = CASE WHEN excluded.samples > samples THEN excluded.wind_direction ELSE wind_direction END, symbol = CASE WHEN excluded.samples > samples THEN excluded.symbol ELSE symbol END, wet = wet + excluded.wet'''
+
+
+def rollups(location_id, timezone, rows):
+    """forecast_daily rows for forecast table rows of one location, sorted by time."""
+    store = database.ForecastStore(location_id, [row[1:] for row in rows], timezone)
+    return [(location_id, day.day, day.end - day.start, int(round(day.temp_min * TEMP_SCALE)),
+             int(round(day.temp_max * TEMP_SCALE)), int(round(day.temp_mean * TEMP_SCALE)), int(round(day.pressure)),
+             int(round(day.humidity)), int(round(day.clouds)), int(round(day.wind_mean * WIND_SCALE)),
+             int(round(day.wind_max * WIND_SCALE)), int(round(day.wind_direction)) % 360, day.condition,
+             int(round(day.precipitation * (day.end - day.start))))
+            for day in analytics.ForecastTable(store).days()]
+
+
+def from_row(row):
+    (location_id, day, samples, temp_min, temp_max, temp_mean, pressure, humidity, clouds, wind_mean, wind_max,
+     wind_direction, symbol, wet) = row
+    return DailyForecast(location_id, day, samples, temp_min / float(TEMP_SCALE), temp_max / float(TEMP_SCALE),
+                         temp_mean / float(TEMP_SCALE), pressure, humidity, clouds, wind_mean / float(WIND_SCALE),
+                         wind_max / float(WIND_SCALE), wind_direction, symbol, wet / float(samples))
+
+
+def daily_async(location_id, first_day=0, last_day=None):
+    """A future of the location's DailyForecasts from first_day to last_day, local days since 1970, oldest first.
+
+    Only days which have been compacted are there, the last RAW_DAYS are still raw forecasts.
+    """
+    command = '''SELECT * FROM forecast_daily WHERE location_id = ? AND day BETWEEN ? AND ? ORDER BY day ASC'''
+    last_day = (1 << 62) if last_day is None else last_day
+    return database.map_future(database._db.select_async(command, (location_id, first_day, last_day)),
+                               lambda rows: [from_row(row) for row in rows])
+
+
+def daily(location_id, first_day=0, last_day=None):
+    return database._db.wait(daily_async(location_id, first_day, last_day))
+
+
+class Compactor(database.ClockTask):
+    """Rolls old forecasts up into forecast_daily in the background, batch_size forecasts at a time.
+
+    Each step reads the oldest forecasts which are more than raw_days whole local days old, summarises them a
+    location and day at a time with analytics.ForecastTable and queues one transaction which writes the rollups
+    and deletes the forecasts they replace. After a full batch the next step follows step_delay later, otherwise the
+    next look is interval later. A database.ClockTask like RefreshScheduler, pause and resume it with it.
+    """
+    def __init__(self, raw_days=RAW_DAYS, batch_size=COMPACT_BATCH, step_delay=COMPACT_STEP_DELAY,
+                 interval=COMPACT_INTERVAL):
+        super(Compactor, self).__init__(interval)
+        self.raw_days = raw_days
+        self.batch_size = batch_size
+        self.step_delay = step_delay
+        self.busy = False  # A step's select is out
+        self.compacted = 0  # Forecasts rolled up and deleted
+        self.days = 0  # forecast_daily rows written
+        self.steps = 0
+
+    @property
+    def stats(self):
+        return {'compacted': self.compacted, 'days': self.days, 'steps': self.steps}
+
+    def step(self, dt=None):
+        self.event = None
+        if self.paused or self.busy:
+            return
+        self.busy = True
+        now = int(time())
+        # The range on time alone lets the forecast_time index find the candidates, the test on local days then
+        # leaves the last raw_days whole. after_writes so the previous step's deletes are seen
+        command = '''SELECT forecast.*, location.timezone FROM forecast JOIN location ON location.location_id = ''' \
+                  '''forecast.location_id WHERE forecast.time < ? AND (forecast.time + CAST(location.timezone * ''' \
+                  '''3600 AS INTEGER)) / 86400 < (? + CAST(location.timezone * 3600 AS INTEGER)) / 86400 - ? ''' \
+                  '''ORDER BY forecast.time ASC LIMIT ?'''
+        future = database._db.select_async(command, (now - self.raw_days * 86400, now, self.raw_days,
+                                                     self.batch_size), priority=COMPACT_PRIORITY, after_writes=True)
+        database.on_main_thread(future, self.compact, self.on_failure)
+
+    run = step
+
+    def on_failure(self, error):
+        self.busy = False
+        super(Compactor, self).on_failure(error)
+
+    def compact(self, rows):
+        started = time()
+        self.busy = False
+        full = len(rows) == self.batch_size
+        if full:
+            rows = self.whole_days(rows)
+        rolled = []
+        for (location_id, timezone), location_rows in groupby(sorted(rows, key=lambda row: (row[1], row[2])),
+                                                              key=lambda row: (row[1], row[-1])):
+            rolled.extend(rollups(location_id, timezone, [row[:-1] for row in location_rows]))
+        if rows:
+            with database._db.transaction(priority=COMPACT_PRIORITY) as transaction:
+                transaction.executemany(UPSERT, rolled)
+                transaction.executemany('''DELETE FROM forecast WHERE forecast_id = ?''', [(row[0],) for row in rows])
+        self.compacted += len(rows)
+        self.days += len(rolled)
+        self.steps += 1
+        instrumentation.record_since('history.compact', started)
+        if rows and not full:  # The backlog is done
+            Logger.info(Formatter().format('Compactor: {compacted} forecasts rolled up into {days} days in '
+                                           '{steps} steps', **self.stats))
+        if not self.paused:
+            self.schedule(self.step_delay if full else self.interval)
+
+    @staticmethod
+    def whole_days(rows):
+        # A full batch may stop part way through the last day of each location, those days wait for the next step.
+        # Unless that's every row, then they're merged into the rollups when the rest arrives
+        newest = rows[-1][2]
+        last_days = {}
+        for row in rows:
+            last_days.setdefault(row[1], database.local_day(newest, row[-1]))
+        whole = [row for row in rows if database.local_day(row[2], row[-1]) < last_days[row[1]]]
+        return whole or rows
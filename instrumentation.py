@@ -0,0 +1,111 @@
+"""Timings of the app's hot paths, kept in memory as histograms.
+
+Off unless ``instrumentation = 1`` is set in the ``[weather]`` section of
+the Kivy config, or enable() is called. While off, record does nothing
+but check a flag. What has been recorded is shown on the debug screen
+and written out as JSON by dump.
+"""
+import json
+from kivy.config import Config
+from math import frexp
+from string import Formatter
+from threading import Lock
+from time import time
+
+DUMP_FILE = 'instrumentation.json'
+PERCENTILES = (0.5, 0.9, 0.99)
+
+enabled = bool(Config.getdefaultint('weather', 'instrumentation', 0))
+histograms = {}  # Name: Histogram
+lock = Lock()  # record is called from the database threads as well as the main one
+
+
+class Histogram:
+    """Counts of values in power of two buckets, so it stays the same small size however many values are added.
+
+    Percentiles are the top of the bucket they fall in, at most twice the real value. Works for any unit, the
+    names say which: seconds for timings, bytes for sizes.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.low = None
+        self.high = None
+        self.buckets = {}  # Exponent: number of values between 2 ** (exponent - 1) and 2 ** exponent
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.low is None or value < self.low:
+            self.low = value
+        if self.high is None or value > self.high:
+            self.high = value
+        exponent = frexp(value)[1] if value > 0 else None  # None holds zeros
+        self.buckets[exponent] = self.buckets.get(exponent, 0) + 1
+
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for exponent in sorted(self.buckets, key=lambda exponent: float('-inf') if exponent is None else exponent):
+            seen += self.buckets[exponent]
+            if seen >= rank:
+                return 0 if exponent is None else min(2.0 ** exponent, self.high)
+        return self.high
+
+    def summary(self):
+        summary = {'count': self.count, 'total': self.total, 'mean': self.total / self.count if self.count else None,
+                   'min': self.low, 'max': self.high}
+        for fraction in PERCENTILES:
+            summary['p' + str(int(fraction * 100))] = self.percentile(fraction)
+        return summary
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def record(name, value):
+    if not enabled:
+        return
+    with lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.add(value)
+
+
+def record_since(name, started):
+    # For timings, started is what time() was when the timed work began
+    if enabled:
+        record(name, time() - started)
+
+
+def snapshot():
+    # Name: summary dict, sorted by name
+    with lock:
+        return dict((name, histograms[name].summary()) for name in sorted(histograms))
+
+
+def reset():
+    with lock:
+        histograms.clear()
+
+
+def report():
+    """One line per histogram for the debug screen, timings in ms and sizes in KB."""
+    lines = []
+    for name, summary in sorted(snapshot().items()):
+        scale, unit = (1 / 1024.0, 'KB') if name.endswith('.bytes') else (1000, 'ms')
+        lines.append(Formatter().format('{name:<36} {count:>6}  p50 {p50:8.2f}  p99 {p99:8.2f}  max {max:8.2f} {unit}',
+                                        name=name, count=summary['count'], p50=summary['p50'] * scale,
+                                        p99=summary['p99'] * scale, max=summary['max'] * scale, unit=unit))
+    return lines
+
+
+def dump(file=DUMP_FILE):
+    with open(file, 'w') as output:
+        json.dump({'time': time(), 'histograms': snapshot()}, output, indent=2, sort_keys=True)
+    return file
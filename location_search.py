@@ -0,0 +1,143 @@
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from kivy.clock import Clock
+from kivy.logger import Logger
+import re
+from string import Formatter
+from urllib.parse import quote
+import database
+import response_cache
+
+SEARCH_DELAY = 0.4  # Seconds typing has to pause for before a search is sent
+MIN_QUERY_LENGTH = 3  # OpenWeatherMap's find endpoint needs at least this many characters
+SEARCH_CACHE_SIZE = 64  # Queries whose results are kept in memory, least recently used dropped first
+MAX_LOCAL_RESULTS = 10
+COORDINATES = re.compile(r'^\s*(-?\d+(?:\.\d*)?)\s*,\s*(-?\d+(?:\.\d*)?)\s*$')  # "51.5, -0.12" finds the nearest towns
+
+
+def normalise(query):
+    return ' '.join(query.lower().split())
+
+
+class PrefixIndex:
+    """Locations sorted by town name, so every town starting with a prefix is a bisect away."""
+    def __init__(self):
+        self.keys = []  # (normalised town, location id), sorted
+        self.locations = {}  # Location id: location
+
+    def __len__(self):
+        return len(self.locations)
+
+    def add(self, locations):
+        for location in locations:
+            if location.id not in self.locations:
+                insort(self.keys, (normalise(location.town), location.id))
+            self.locations[location.id] = location  # A saved location replaces the searched one it came from
+
+    def search(self, prefix, limit=MAX_LOCAL_RESULTS):
+        prefix = normalise(prefix)
+        results = []
+        for key, location_id in self.keys[bisect_left(self.keys, (prefix,)):]:
+            if not key.startswith(prefix) or len(results) == limit:
+                break
+            results.append(self.locations[location_id])
+        return results
+
+
+class LocationSearch:
+    """Type-ahead search for towns in front of OpenWeatherMap's find endpoint.
+
+    search debounces, only the last query typed within SEARCH_DELAY is looked up. on_results(query, locations, final)
+    is called with the towns already known locally first (final False), then with the endpoint's answer (final
+    True). Recent answers are kept in an LRU so repeating a query doesn't touch the network, and a newer query cancels
+    the request of the one before so a slow response can't overwrite newer results. With a gazetteer, searches
+    that fail are answered from it and a latitude, longitude query finds the nearest towns. Runs on the Kivy main
+    thread.
+    """
+    def __init__(self, on_results, delay=SEARCH_DELAY, cache_size=SEARCH_CACHE_SIZE, gazetteer=None):
+        self.on_results = on_results
+        self.gazetteer = gazetteer  # A gazetteer.Gazetteer or None
+        self.delay = delay
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # Normalised query: locations
+        self.index = PrefixIndex()
+        self.event = None
+        self.request = None
+        self.generation = 0  # Bumped by every query, responses for an older one are dropped
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'cached': len(self.cache), 'indexed': len(self.index)}
+
+    def add_locations(self, locations):
+        self.index.add(locations)
+
+    def search(self, query):
+        # Called on every keystroke
+        self.cancel()
+        if len(normalise(query)) >= MIN_QUERY_LENGTH:
+            self.event = Clock.schedule_once(lambda dt: self.search_now(query), self.delay)
+
+    def search_now(self, query):
+        self.cancel()
+        self.event = None
+        key = normalise(query)
+        coordinates = COORDINATES.match(query)
+        if coordinates is not None and self.gazetteer is not None:
+            lat, lon = float(coordinates.group(1)), float(coordinates.group(2))
+            self.on_results(query, self.gazetteer.nearest(lat, lon, MAX_LOCAL_RESULTS), True)
+            return
+        if key in self.cache:
+            self.hits += 1
+            self.cache[key] = self.cache.pop(key)  # Now the most recently used
+            self.on_results(query, self.with_local(key, self.cache[key]), True)
+            return
+        self.misses += 1
+        local = self.index.search(key)
+        if local:
+            self.on_results(query, local, False)
+        generation = self.generation
+        # Every value quoted so towns like New York or Saint-Ouen-l'Aumône, stray & or # typed in and whatever is in
+        # the API key all stay inside their parameter
+        url = Formatter().format(database.URLS['find_location'], location=quote(query, safe=''),
+                                 appid=quote(database.OPENWEATHERKEY, safe=''))
+        self.request = response_cache._cache.request(
+            url, 'find_location', lambda req, data: self.on_response(generation, key, query, data),
+            on_failure=lambda req, result: self.on_failure(generation, query, result),
+            on_error=lambda req, result: self.on_failure(generation, query, result))
+
+    def cancel(self):
+        # Drops the pending query and any request in flight, their results are never passed on
+        self.generation += 1
+        if self.event is not None:
+            self.event.cancel()
+            self.event = None
+        if self.request is not None:
+            self.request.cancel()
+            self.request = None
+
+    def on_response(self, generation, key, query, data):
+        if generation != self.generation:
+            return
+        self.request = None
+        locations = [database.location_from_json(data, count) for count in range(data['count'])]
+        self.cache[key] = locations
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        self.index.add(locations)
+        self.on_results(query, self.with_local(key, locations), True)
+
+    def with_local(self, key, locations):
+        # The endpoint's towns first, then the local ones it didn't return
+        found = set(location.id for location in locations)
+        return locations + [location for location in self.index.search(key) if location.id not in found]
+
+    def on_failure(self, generation, query, result):
+        if generation != self.generation:
+            return
+        self.request = None
+        Logger.warn(Formatter().format('Searching for {query} failed: {result}', query=query, result=result))
+        offline = self.gazetteer.search(query) if self.gazetteer is not None else []
+        self.on_results(query, self.with_local(normalise(query), offline), True)  # The local matches are all there is
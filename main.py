@@ -1,32 +1,46 @@
-from datetime import datetime
+from collections import OrderedDict
 from functools import partial
 from kivy.app import App
 from kivy.base import Clock, Config
 from kivy.core.text import LabelBase
 from kivy.logger import Logger
 from kivy.metrics import sp
-from kivy.network.urlrequest import UrlRequest
 from kivy.properties import ObjectProperty
 from kivy.uix.button import Button
-from kivy.uix.listview import ListItemButton
 from kivy.uix.popup import Popup
 from kivy.uix.screenmanager import Screen, ScreenManager, RiseInTransition
-from kivy.utils import get_color_from_hex as c, Platform
+from kivy.utils import get_color_from_hex as c, platform
 from string import Formatter
+from time import time
+import analytics
 import database
+from gazetteer import open_gazetteer
+import history
+import instrumentation
+from location_search import LocationSearch, MIN_QUERY_LENGTH
+import response_cache
 
 LabelBase.register('symbols', fn_regular='assets/weathersymbols.ttf')
 COLOURS = ['FF3B30', '2ECC71', '3498DB', '1ABC9C', '27AE60', 'E74C3C']
-mobile_platform = Platform() in ('ios', 'android')
+MAX_LOCATION_SCREENS = 3  # SimpleWeatherScreens kept in the ScreenManager, least recently shown dropped first
+MAINTENANCE_DELAY = 2  # Seconds after the first frame before old forecasts are compacted and the refreshes start
+INSTRUMENTATION_INTERVAL = 1  # Seconds between updates of the instrumentation screen while it's shown
+mobile_platform = platform in ('ios', 'android')
 if not mobile_platform:
     # This must be here because a mobile screen is high density
     Config.set('graphics', 'height', int(1280 * 0.5))  # 50% of screen size
     Config.set('graphics', 'width', int(720 * 0.5))  # 50% of screen size
 Config.set('kivy', 'log_level', 'warning')
 
-def find_location(location, on_success):
-    url = Formatter().format(database.URLS['find_location'], location=location, appid=database.OPENWEATHERKEY)
-    UrlRequest(url, on_success=on_success)
+def log_build(name, round_trips_before, started):
+    # Every round trip blocks the UI thread until the database thread answers
+    Logger.info(Formatter().format('{name}: built with {count} database round trips',
+                                   name=name, count=database._db.round_trips - round_trips_before))
+    instrumentation.record_since('screen.' + name + '.build', started)
+
+
+def screen_name(location):
+    return Formatter().format('location {id}', id=location.id)
 
 
 class LargeButton(Button):
@@ -34,18 +48,14 @@ class LargeButton(Button):
 
 
 class LocationButton(LargeButton):
-    def __init__(self, location, **kwargs):
+    def __init__(self, location, current_weather, **kwargs):
         self.location = location  # This is here because object is linked to .kv in super and we need location attribute
-        self.current_weather = self.location.get_current_weather
+        self.current_weather = current_weather
         super(LocationButton, self).__init__(**kwargs)
         self.long_press_clock = None
 
     def on_location_button_press(self):
-        if not root.has_screen(self.location.town):
-            root.add_widget(
-                SimpleWeatherScreen(self.location)
-            )
-        root.current = self.location.town
+        location_screens.show(self.location)
 
     def create_clock(self, touch):
         function = partial(self.menu, touch)
@@ -88,7 +98,7 @@ class LargeGrid:
     pass
 
 
-class RectangleButton(ListItemButton):
+class RectangleButton(Button):
     iter_number = 0
 
     def __init__(self, forecast=None, **kwargs):  # I dont think this should have forecast in it
@@ -98,6 +108,15 @@ class RectangleButton(ListItemButton):
         self.forecast = forecast
 
 
+class ForecastRow(RectangleButton):
+    # Built and reused by the RecycleView in SimpleWeatherScreen, which sets these from its data
+    forecast = ObjectProperty(allownone=True)
+    screen = ObjectProperty(allownone=True)
+
+    def on_release(self):
+        self.screen.on_weather_time_press(self)
+
+
 class SearchRectangleButton(RectangleButton):
 
     def __init__(self, location, **kwargs):
@@ -106,7 +125,8 @@ class SearchRectangleButton(RectangleButton):
 
     def on_result_press(self, button):
         location = button.location
-        location.save_to_db()
+        if location.id not in database.Location._identity_map:  # Search also offers the locations already saved
+            location.save_to_db(on_timezone=lambda location: root.get_screen('menu').populate())  # Night symbols move
         root.get_screen('menu').populate()
         root.current = 'menu'
         root.get_screen('addform').reset()
@@ -131,6 +151,7 @@ class DeleteDialog(Popup):
 
     def on_yes_press(self):
         self.location.remove_from_db()
+        location_screens.remove(self.location.id)
         root.get_screen('menu').populate()
         self.dismiss()
 
@@ -146,27 +167,35 @@ class AddLocationForm(Screen):
         self.results = self.ids.get('results')
         self.results.bind(minimum_height=self.results.setter('height'))
         self.input = self.ids.get('input')
+        self.search = LocationSearch(self.on_search_results, gazetteer=open_gazetteer())
+
+    def on_enter(self):
+        # Saved locations answer searches for them straight away
+        database.on_main_thread(database.Location.all_locations_async(), self.search.add_locations)
+
+    def on_input(self, text):
+        self.search.search(text)  # Debounced, only sent once typing pauses
 
     def on_search(self):
         location = self.input.text
-        if len(location) < 3:
+        if len(location) < MIN_QUERY_LENGTH:
             popup_widget = AddLocErrorForm()
             popup_widget.open()
         else:
-            find_location(location, self.on_found_search)
+            self.search.search_now(location)
 
-    def on_found_search(self, _, data):
+    def on_search_results(self, query, locations, final):
+        # Local matches arrive first and are replaced by the endpoint's answer when final
         self.results.clear_widgets()
-        if data['count'] > 0:
-            for count in range(data['count']):
-                location = database.location_from_json(data, count)
+        if locations:
+            for location in locations:
                 button = SearchRectangleButton(
                     location,
                     font_size=60 if mobile_platform else 30,
                 )
                 button.bind(on_release=self.reset)
                 self.results.add_widget(button)
-        else:  # else nothing found
+        elif final:  # else nothing found
             button = RectangleButton(
                 font_size=60 if mobile_platform else 30,
                 text='Nothing Found',
@@ -179,6 +208,7 @@ class AddLocationForm(Screen):
         self.results.remove_widget(button)
 
     def reset(self, widget=None):
+        self.search.cancel()
         self.input.text = ''
         self.results.clear_widgets()
         if widget is not None:
@@ -202,67 +232,127 @@ class SimpleWeatherScreen(Screen):
     location = ObjectProperty()
 
     def __init__(self, location):
+        started = time()
+        round_trips = database._db.round_trips
         super(SimpleWeatherScreen, self).__init__()
         self.location = location
-        self.name = self.location.town
+        self.name = screen_name(self.location)  # Towns can share a name, ids can't
         self.simple_weather_scroll = self.ids.get('SimpleWeatherScroll')
-        self.simple_weather_scroll.bind(minimum_height=self.simple_weather_scroll.setter('height'))
-        self.forecasts = self.location.forecasts
         self.ids.get('simple_menu_title').text = self.location.town
-        for count, forecast in enumerate(self.forecasts):
-            day_time = datetime.fromtimestamp(forecast.time)
-            day = database.weekdays[day_time.weekday()]
-            if day_time.day == datetime.now().day:
-                day = 'Today'
-            elif day_time.day == datetime.now().day + 1:  # Not sure this is gonna work at the end of the month
-                day = 'Tomorrow'
-            button_text = Formatter().format('[font=symbols]{symbol}[/font] {weekday} {time}:00',
-                                             symbol=forecast.symbol,
-                                             weekday=day,
-                                             time=(day_time.hour + location.timezone) % 24)
-            widget = RectangleButton(forecast=forecast,
-                                     text=button_text,
-                                     background_color=c(COLOURS[count % len(COLOURS)]),
-                                     font_size=80 if mobile_platform else 40)
-            widget.bind(on_release=self.on_weather_time_press)
-            self.simple_weather_scroll.add_widget(widget)
+        self.reload()
+        log_build('SimpleWeatherScreen', round_trips, started)
+
+    def reload(self):
+        self.forecasts = self.location.forecasts
+        self.table = analytics.ForecastTable(self.location.store)
+        self.simple_weather_scroll.data = self.forecast_rows(self.forecasts, self.table)  # Only visible rows get widgets
+
+    def forecast_rows(self, forecasts, table):
+        # A summary row heads each day's forecasts
+        rows = []
+        today = database.local_day(int(time()), self.location.timezone)
+        for day in table.days():
+            rows.append({'viewclass': 'DaySummaryRow',
+                         'text': Formatter().format('{day}  {low:.0f} to {high:.0f}[sup]o[/sup]C  '
+                                                    '[font=symbols]{symbol}[/font]  {rain:.0%} wet',
+                                                    day=database.day_label(day.day, today), low=day.temp_min,
+                                                    high=day.temp_max,
+                                                    symbol=database.get_symbol_from_number(day.condition),
+                                                    rain=day.precipitation)})
+            for count in range(day.start, day.end):
+                forecast = forecasts[count]
+                button_text = Formatter().format('[font=symbols]{symbol}[/font] {weekday} {time}:00',
+                                                 symbol=forecast.symbol,
+                                                 weekday=database.day_label(day.day, today),
+                                                 time=forecast.hour)
+                rows.append({'text': button_text,
+                             'forecast': forecast,
+                             'screen': self,
+                             'background_color': c(COLOURS[count % len(COLOURS)])})
+        return rows
 
     def on_weather_time_press(self, widget):
-        new_screen = DetailedWeatherScreen(widget.forecast)
-        self.manager.add_widget(new_screen)
-        self.manager.current = new_screen.name
+        if not self.manager.has_screen('detailed'):
+            self.manager.add_widget(DetailedWeatherScreen())  # One screen shared by every forecast
+        detailed_screen = self.manager.get_screen('detailed')
+        detailed_screen.show(widget.forecast, self.table)
+        self.manager.current = detailed_screen.name
 
     def refresh_and_change_screen(self):
         self.manager.current = 'menu'
 
 
 class DetailedWeatherScreen(Screen):
-    def __init__(self, forecast):
-        location = forecast.location
-        name = location.town + str(forecast.time)
-        super(DetailedWeatherScreen, self).__init__(name=name)
-        self.location = location
+    def __init__(self):
+        super(DetailedWeatherScreen, self).__init__(name='detailed')
+        self.location = None
+        self.forecast = None
+        self.ids.get('detailed_return_button').bind(on_release=self.return_to_simple_screen)
+
+    def show(self, forecast, table):
+        # table is the SimpleWeatherScreen's analytics.ForecastTable, the forecast's figures are read from it
+        self.location = forecast.location
         self.forecast = forecast
-        day_time = datetime.fromtimestamp(forecast.time)
+        index = table.index(forecast.time)
+        day = table.day_of(index)
         detailed_menu_title = self.ids.get('detailed_menu_title')
-        detailed_menu_title.text = Formatter().format('{town} {hour}:00', town=self.location.town, hour=(day_time.hour + self.location.timezone) % 24)
-        self.ids.get('detailed_return_button').bind(on_release=self.return_to_simple_screen)
+        detailed_menu_title.text = Formatter().format('{town} {hour}:00', town=self.location.town,
+                                                      hour=forecast.hour)
         detailed_menu_symbol = self.ids.get('detailed_menu_symbol')
         detailed_menu_symbol.text = Formatter().format('[font=symbols]{symbol}[/font]', symbol=forecast.symbol)
-        text = Formatter().format('[font=symbols]k[/font]Temperature: {temperature}[sup]o[/sup]C\n'
-                                  'Pressure: {pressure} Pa\nHumidity: {humidity} %\n'
-                                  '\nClouds Cover: {clouds} %\nWind Speed: {clouds} m/s\n'
-                                  'Wind Direction: {direction}[sup]o[/sup]',
-                                  temperature=int(self.forecast.temp - 273),
-                                  pressure=int(self.forecast.pressure) * 100,  # To convert hPa to Pa
-                                  humidity=self.forecast.humidity,
-                                  clouds=self.forecast.clouds,
-                                  wind_speed=self.forecast.wind_speed,
-                                  direction=int(self.forecast.wind_direction))
+        text = Formatter().format('[font=symbols]k[/font]Temperature: {temperature:.0f}[sup]o[/sup]C\n'
+                                  'Pressure: {pressure:.0f} Pa\nHumidity: {humidity} %\n'
+                                  '\nClouds Cover: {clouds} %\nWind Speed: {wind_speed} m/s\n'
+                                  'Wind Direction: {direction:.0f}[sup]o[/sup]\n'
+                                  '\nDay: {low:.0f} to {high:.0f}[sup]o[/sup]C, wind up to {gust:.1f} m/s',
+                                  temperature=table.celsius[index],
+                                  pressure=table.pascals[index],
+                                  humidity=table.humidity[index],
+                                  clouds=table.clouds[index],
+                                  wind_speed=table.wind_speed[index],
+                                  direction=table.wind_direction[index],
+                                  low=day.temp_min, high=day.temp_max, gust=day.wind_max)
         self.ids.get('detailed_menu_text').text = text
 
     def return_to_simple_screen(self, widget):
-        self.manager.current = self.location.town
+        location_screens.show(self.location)  # Its screen may have been dropped while this one was shown
+
+
+class LocationScreens:
+    """Keeps a SimpleWeatherScreen for the most recently shown locations.
+
+    Past the limit the least recently shown screen is removed from the ScreenManager and built again if it is
+    shown later. Screens whose forecasts were refreshed are removed the same way, or reloaded if on display.
+    """
+    def __init__(self, manager, limit=MAX_LOCATION_SCREENS):
+        self.manager = manager
+        self.limit = limit
+        self.screens = OrderedDict()  # location_id -> SimpleWeatherScreen, least recently shown first
+
+    def show(self, location):
+        screen = self.screens.pop(location.id, None)
+        if screen is None:
+            screen = SimpleWeatherScreen(location)
+            self.manager.add_widget(screen)
+        self.screens[location.id] = screen
+        self.manager.current = screen.name
+        while len(self.screens) > self.limit:
+            self.manager.remove_widget(self.screens.popitem(last=False)[1])
+
+    def remove(self, location_id):
+        screen = self.screens.pop(location_id, None)
+        if screen is not None:
+            self.manager.remove_widget(screen)
+
+    def refreshed(self, location_ids):
+        for location_id in location_ids:
+            screen = self.screens.get(location_id)
+            if screen is None:
+                continue
+            if self.manager.current == screen.name:
+                screen.reload()
+            else:
+                self.remove(location_id)
 
 
 class MenuScreen(Screen):
@@ -273,11 +363,18 @@ class MenuScreen(Screen):
         self.populate()
 
     def populate(self):
+        # The current buttons stay until the locations arrive from the database thread. after_writes so a location
+        # which was just added or deleted is shown that way
+        database.on_main_thread(database.Location.all_with_current_forecast(after_writes=True), self.on_locations)
+
+    def on_locations(self, locations):
+        started = time()
+        round_trips = database._db.round_trips
         self.location_grid.clear_widgets()
-        locations = database.Location.all_locations()
-        for iteration, location in enumerate(locations):
+        for iteration, (location, current_weather) in enumerate(locations):
             button = LocationButton(
                 location,
+                current_weather,
                 background_color=c(COLOURS[iteration % len(COLOURS)]),
             )
             self.location_grid.add_widget(button)
@@ -288,33 +385,104 @@ class MenuScreen(Screen):
         )
         button.bind(on_release=self.on_add_button_press)
         self.location_grid.add_widget(button)
+        if root.has_screen('instrumentation'):
+            button = LargeButton(text='Stats', font_size=sp(50), background_color=c('#7F8C8D'))
+            button.bind(on_release=self.on_stats_button_press)
+            self.location_grid.add_widget(button)
+        log_build('MenuScreen', round_trips, started)
 
     @staticmethod
     def on_add_button_press(widget):
         root.current = 'addform'
 
+    @staticmethod
+    def on_stats_button_press(widget):
+        root.current = 'instrumentation'
+
+
+class InstrumentationScreen(Screen):
+    """Debug screen listing the instrumentation histograms, only added when instrumentation is enabled."""
+    def __init__(self):
+        super(InstrumentationScreen, self).__init__(name='instrumentation')
+        self.event = None
+
+    def on_enter(self):
+        self.update()
+        self.event = Clock.schedule_interval(self.update, INSTRUMENTATION_INTERVAL)
+
+    def on_leave(self):
+        self.event.cancel()
+        self.event = None
+
+    def update(self, dt=None):
+        lines = instrumentation.report()
+        self.ids.get('instrumentation_text').text = '\n'.join(lines) if lines else 'Nothing recorded yet'
+
+    def on_save(self):
+        file = instrumentation.dump()
+        self.ids.get('instrumentation_title').text = Formatter().format('Saved to {file}', file=file)
+
+    def on_reset(self):
+        instrumentation.reset()
+        self.update()
+
 
 class WeatherApp(App):  # Will import weather.kv automatically
     def __init__(self):
         super(WeatherApp, self).__init__()
         self.title = 'Weather Application'
         self.icon = 'assets\\icon.png'
-        database._db.remove_old_forecasts()
-        database.refresh_forecasts()
+        # Refreshes stale forecasts while the app runs
+        self.scheduler = database.RefreshScheduler(on_refreshed=self.on_forecasts_refreshed)
+        self.compactor = history.Compactor()  # Rolls past forecasts up into daily history
 
     def build(self):
+        if instrumentation.enabled:
+            root.add_widget(InstrumentationScreen())  # Before the menu, which only offers it when it's there
         root.add_widget(MenuScreen())
         root.add_widget(AddLocationForm())
+        root.current = 'menu'
         return root
 
+    def on_start(self):
+        # The menu is drawn from what's already in the database first, maintenance waits until it has been shown
+        self.root_window.bind(on_flip=self.on_first_frame)
+
+    def on_first_frame(self, window):
+        window.unbind(on_flip=self.on_first_frame)
+        Logger.info(Formatter().format('WeatherApp: first frame {elapsed:.3f} s after start',
+                                       elapsed=Clock.get_boottime()))
+        Clock.schedule_once(self.maintenance, MAINTENANCE_DELAY)
+
+    def maintenance(self, dt=None):
+        self.compactor.start()
+        self.scheduler.start()
+
+    @staticmethod
+    def on_forecasts_refreshed(refresher):
+        location_screens.refreshed(refresher.refreshed)
+
     def on_pause(self):  # For mobile devices
+        self.scheduler.pause()
+        self.compactor.pause()
         return True
 
+    def on_resume(self):
+        self.scheduler.resume()  # Checks straight away, anything that went stale while paused is refreshed
+        self.compactor.resume()
+
     def on_stop(self):
+        self.scheduler.pause()
+        self.compactor.pause()
+        if instrumentation.enabled:
+            Logger.info(Formatter().format('WeatherApp: instrumentation written to {file}',
+                                           file=instrumentation.dump()))
         database._db.close()
+        response_cache._cache.close()
 
 
 root = ScreenManager(transition=RiseInTransition())
+location_screens = LocationScreens(root)
 
 if __name__ in ('__main__', '__android__'):
     app = WeatherApp()
@@ -0,0 +1,173 @@
+from collections import OrderedDict
+from functools import partial
+import instrumentation
+import json
+from kivy.clock import Clock
+from kivy.logger import Logger
+from kivy.network.urlrequest import UrlRequest
+import sqlite3
+import storage
+from string import Formatter
+from time import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Seconds a response is used without asking the server again, keyed on the names in database.URLS. get_forecasts
+# has none, database.RefreshScheduler already waits until forecasts are old enough, so they're always revalidated
+TTLS = {
+    'find_location': 24 * 60 * 60  # Towns don't move
+}
+MAX_CACHE_BYTES = 4 * 1024 * 1024  # Least recently used responses are dropped past this
+PRIVATE_PARAMETERS = ('appid', 'key')  # Left out of the cache key so changing the API key keeps the cache
+COMMIT_DELAY = 5  # Seconds writes wait to be committed together
+CACHE_FILE = 'responses.db'
+
+
+def received(req, size, total):
+    # UrlRequest's on_progress, for the size of responses sent without a Content-Length. Only passed while
+    # instrumentation is on, as it makes UrlRequest read the body in chunks
+    req.received = size
+
+
+def cache_key(url):
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    parameters = sorted((name, value) for name, value in parse_qsl(query) if name.lower() not in PRIVATE_PARAMETERS)
+    return urlunsplit((scheme, netloc, path, urlencode(parameters), ''))
+
+
+class ResponseCache:
+    """On disk cache of decoded JSON responses in front of UrlRequest.
+
+    Responses younger than their endpoint's TTL are answered from disk. Older ones are revalidated with
+    If-None-Match/If-Modified-Since when the server sent an ETag or Last-Modified. All methods run on the Kivy main
+    thread, the callbacks are called like UrlRequest's but with None for the request when the cache answered.
+    request returns the UrlRequest so it can be cancelled, or None when the cache answered.
+
+    What's cached, and when each response was last used, is kept in memory, so a hit only reads the body by its
+    key. Writes are left in an open transaction and committed together commit_delay seconds after the first of them.
+    """
+    def __init__(self, file, max_bytes=MAX_CACHE_BYTES, commit_delay=COMMIT_DELAY):
+        self.db = sqlite3.connect(file)
+        storage.use_wal(self.db)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS response (key TEXT PRIMARY KEY, endpoint TEXT, body TEXT, etag TEXT, last_modified TEXT, stored REAL, used REAL, size INTEGER)''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS response_used ON response (used)''')
+        self.db.commit()
+        self.max_bytes = max_bytes
+        self.commit_delay = commit_delay
+        self.entries = OrderedDict()  # Key: [etag, last modified, stored, size], least recently used first
+        for key, etag, last_modified, stored, size in self.db.execute(
+                '''SELECT key, etag, last_modified, stored, size FROM response ORDER BY used ASC'''):
+            self.entries[key] = [etag, last_modified, stored, size]
+        self.total = sum(entry[3] for entry in self.entries.values())
+        self.used = {}  # Key: time it was last used, not written yet
+        self.event = None
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'revalidated': self.revalidated}
+
+    def request(self, url, endpoint, on_success, on_failure=None, on_error=None):
+        key = cache_key(url)
+        entry = self.entries.get(key)
+        if entry is not None and time() - entry[2] < TTLS.get(endpoint, 0):
+            self.hits += 1
+            self.touch(key)
+            body = self.db.execute('''SELECT body FROM response WHERE key = ?''', (key,)).fetchone()[0]
+            Clock.schedule_once(lambda dt: on_success(None, json.loads(body)))  # Asynchronous like UrlRequest
+            instrumentation.record('http.' + endpoint + '.cached.bytes', len(body))
+            return None
+        self.misses += 1
+        headers = {}
+        if entry is not None:
+            if entry[0]:
+                headers['If-None-Match'] = entry[0]
+            if entry[1]:
+                headers['If-Modified-Since'] = entry[1]
+        # partial holds the callbacks strongly, UrlRequest itself only keeps weak references to bound methods
+        started = time()
+        return UrlRequest(url, req_headers=headers,
+                          on_success=partial(self.on_response, key, endpoint, started, on_success),
+                          on_redirect=partial(self.on_not_modified, key, endpoint, started, on_success, on_failure),
+                          on_failure=partial(self.on_failed, endpoint, started, on_failure),
+                          on_error=partial(self.on_failed, endpoint, started, on_error),
+                          on_progress=received if instrumentation.enabled else None)
+
+    def on_response(self, key, endpoint, started, on_success, req, result):
+        instrumentation.record_since('http.' + endpoint + '.latency', started)
+        headers = dict((name.lower(), value) for name, value in (req.resp_headers or {}).items())
+        body = json.dumps(result)
+        now = time()
+        self.db.execute('''INSERT OR REPLACE INTO response VALUES (?,?,?,?,?,?,?,?)''',
+                        (key, endpoint, body, headers.get('etag'), headers.get('last-modified'), now, now,
+                         len(body)))
+        size = headers.get('content-length') or getattr(req, 'received', None)  # The JSON as sent, not as decoded
+        if size is not None:
+            instrumentation.record('http.' + endpoint + '.bytes', int(size))
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total -= entry[3]
+        self.entries[key] = [headers.get('etag'), headers.get('last-modified'), now, len(body)]
+        self.total += len(body)
+        self.used.pop(key, None)
+        self.evict()
+        self.schedule_commit()
+        on_success(req, result)
+
+    def on_not_modified(self, key, endpoint, started, on_success, on_failure, req, result):
+        entry = self.entries.get(key)
+        if req.resp_status != 304 or entry is None:
+            self.on_failed(endpoint, started, on_failure, req, result)
+            return
+        instrumentation.record_since('http.' + endpoint + '.revalidated', started)
+        self.revalidated += 1
+        entry[2] = time()
+        self.db.execute('''UPDATE response SET stored = ? WHERE key = ?''', (entry[2], key))
+        self.touch(key)
+        body = self.db.execute('''SELECT body FROM response WHERE key = ?''', (key,)).fetchone()[0]
+        on_success(req, json.loads(body))
+
+    @staticmethod
+    def on_failed(endpoint, started, on_failure, req, result):
+        # Failures and errors, timed apart from responses so a timeout doesn't look like a slow server
+        instrumentation.record_since('http.' + endpoint + '.failed', started)
+        if on_failure is not None:
+            on_failure(req, result)
+
+    def touch(self, key):
+        self.used[key] = time()
+        self.entries[key] = self.entries.pop(key)  # Now the most recently used
+        self.schedule_commit()
+
+    def evict(self):
+        while self.total > self.max_bytes and len(self.entries) > 1:  # Never the response just stored
+            key, entry = self.entries.popitem(last=False)
+            self.db.execute('''DELETE FROM response WHERE key = ?''', (key,))
+            self.used.pop(key, None)
+            self.total -= entry[3]
+            Logger.debug(Formatter().format('ResponseCache: evicted {key}', key=key))
+
+    def schedule_commit(self):
+        if self.event is None:
+            self.event = Clock.schedule_once(self.commit, self.commit_delay)
+
+    def commit(self, dt=None):
+        self.event = None
+        self.db.executemany('''UPDATE response SET used = ? WHERE key = ?''',
+                            [(used, key) for key, used in self.used.items()])
+        self.used = {}
+        self.db.commit()
+
+    def close(self):
+        if self.event is not None:
+            self.event.cancel()
+        self.commit()
+        self.db.close()
+
+
+def default_cache():
+    return ResponseCache(CACHE_FILE)
+
+
+_cache = storage.Lazy(default_cache)
@@ -0,0 +1,45 @@
+"""What the app's SQLite databases have in common: the weather database and the response cache."""
+from threading import Lock
+
+
+def use_wal(connection):
+    # connection or cursor, before anything else is done with the file
+    connection.execute('''PRAGMA journal_mode = WAL''')  # Commits append to a log instead of rewriting pages
+    connection.execute('''PRAGMA synchronous = NORMAL''')  # Safe in WAL mode, skips an fsync per commit
+
+
+class Lazy:
+    """Stands in for a module level database, which is only made by factory when it's first used.
+
+    So importing the module doesn't start a thread or open a file, and tests and tools can call use with a factory
+    for another one, such as lambda: ResponseCache(':memory:'), before anything touches it. Whatever Lazy doesn't
+    have itself is the database's. closing are the arguments use closes the database in use with.
+    """
+    def __init__(self, factory, **closing):
+        self.factory = factory
+        self.closing = closing
+        self.instance = None
+        self.lock = Lock()
+
+    @property
+    def started(self):
+        return self.instance is not None
+
+    def __getattr__(self, name):
+        # Only called for what Lazy doesn't have itself
+        if self.instance is None:
+            with self.lock:
+                if self.instance is None:
+                    self.instance = self.factory()
+        return getattr(self.instance, name)
+
+    def use(self, factory):
+        # Closes the database in use, the next one is made by factory
+        self.close(**self.closing)
+        self.factory = factory
+
+    def close(self, *args, **kwargs):
+        with self.lock:
+            instance, self.instance = self.instance, None
+        if instance is not None:
+            instance.close(*args, **kwargs)